@@ -1,54 +1,181 @@
-import io
-import zipfile
-from datetime import date, datetime, timedelta
+import json
+import sqlite3
+import time
+from calendar import monthrange
+from contextlib import closing
+from datetime import date
+from functools import lru_cache
 
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
 
 from src.config import load_settings
-from src.db import get_conn
+from src.db import Connection, fetch_tuples, get_conn, tx
 from src.security import verify_password
 from src.services.init_db import ensure_schema
-from src.services.seed_demo import seed_demo_if_empty, reset_demo, seed_from_csv
+from src.services.seed_demo import SAMPLE_DIR, seed_demo_if_empty, reset_demo
+from src.utils.dates import week_bounds
 
 from pathlib import Path
-from src.services.chatbot import ChatContext, answer_question
+
+
+# =========================
+# SQL récurrents (texte stable => cache de requêtes préparées sqlite3)
+# =========================
+
+SQL_USER = "SELECT id, username, password_hash, role, full_name, is_active FROM users WHERE username=?"
+
+# Référentiels RBAC en un seul aller-retour (colonne kind), découpés en pandas
+SQL_RBAC = """
+SELECT 'missions' AS kind, id AS a, is_active AS b FROM missions
+UNION ALL SELECT 'users', id, is_active FROM users
+UNION ALL SELECT 'leads', mission_id, user_id FROM mission_leads
+UNION ALL SELECT 'assign', mission_id, user_id FROM mission_assignments
+UNION ALL SELECT DISTINCT 'time', mission_id, user_id FROM time_entries WHERE mission_id IS NOT NULL
+"""
+
+SQL_SIM_EXISTS = "SELECT 1 FROM simulations WHERE id=?"
+
+# Grille capacité utilisateurs × jours (?1 début, ?2 fin, ?3 ids JSON).
+# Requête paramétrée plutôt que vue : les bornes de la série de dates sont des paramètres.
+SQL_USER_CAPACITY_DAILY = """
+WITH RECURSIVE dates(day) AS (
+  VALUES (?1)
+  UNION ALL
+  SELECT date(day, '+1 day') FROM dates WHERE day < ?2
+)
+SELECT
+  d.day,
+  u.id AS user_id,
+  u.full_name AS user_name,
+  COALESCE(co.capacity_h, 8) AS capacity_h,
+  COALESCE(l.logged_hours, 0) AS logged_hours,
+  COALESCE(co.capacity_h, 8) - COALESCE(l.logged_hours, 0) AS delta_h
+FROM users u
+CROSS JOIN dates d
+LEFT JOIN capacity_overrides co
+  ON co.user_id = u.id AND co.cap_date = d.day
+LEFT JOIN (
+  SELECT day, user_id, logged_hours
+  FROM kpi_user_load_daily
+  WHERE day BETWEEN ?1 AND ?2
+    AND user_id IN (SELECT value FROM json_each(?3))
+) l
+  ON l.user_id = u.id AND l.day = d.day
+WHERE u.id IN (SELECT value FROM json_each(?3))
+ORDER BY u.full_name, d.day
+"""
+
+SQL_UPSERT_CAPACITY = """
+INSERT INTO capacity_overrides(user_id, cap_date, capacity_h, reason)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(user_id, cap_date) DO UPDATE SET
+  capacity_h=excluded.capacity_h,
+  reason=excluded.reason
+"""
+
+
+@lru_cache(maxsize=16)
+def _insert_sql(table: str, cols: tuple[str, ...]) -> str:
+    """INSERT des lignes de simulation : un texte SQL par (table, colonnes)."""
+    placeholders = ",".join(["?"] * (1 + len(cols)))
+    return f"INSERT INTO {table}(simulation_id,{','.join(cols)}) VALUES ({placeholders})"
+
+
+RBAC_COLUMNS = {
+    "missions": ["id", "is_active"],
+    "users": ["id", "is_active"],
+    "leads": ["mission_id", "user_id"],
+    "assign": ["mission_id", "user_id"],
+    "time": ["mission_id", "user_id"],
+}
+
+# =========================
+# Helpers: Bootstrap (cache)
+# =========================
+
+def _conn_key(conn: Connection):
+    """Clé de cache d'une connexion : jeton de la connexion + génération de la base.
+
+    PRAGMA data_version change à chaque commit d'une *autre* connexion (autre
+    session, CLI, autre process) ; les écritures de la session passent, elles, par
+    clear_query_cache().
+    """
+    return conn.token, conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+CACHE_HASH = {Connection: _conn_key}
+
+@st.cache_resource
+def _bootstrap(db_path: str) -> bool:
+    """Schéma + seed démo si base vide : une seule fois par process (et par base)."""
+    with closing(get_conn(db_path)) as conn:
+        settings = load_settings()
+        ensure_schema(conn, settings=settings)
+        seed_demo_if_empty(conn, settings=settings)
+        conn.commit()
+    return True
+
+
+def _session_conn(db_path: str) -> Connection:
+    """Connexion propre à la session : ses commits / rollbacks ne touchent qu'elle."""
+    conn = st.session_state.get("_db_conn")
+    if conn is None or st.session_state.get("_db_path") != db_path:
+        conn = st.session_state["_db_conn"] = get_conn(db_path)
+        st.session_state["_db_path"] = db_path
+    return conn
 
 
 # =========================
 # Helpers: Auth + RBAC
 # =========================
 
-def _fetch_user(conn, username: str):
-    row = conn.execute(
-        "SELECT id, username, password_hash, role, full_name, is_active FROM users WHERE username=?",
-        (username,),
-    ).fetchone()
-    return dict(row) if row else None
+# cache_resource (pas de copie/pickle) : sqlite3.Row est immuable, partageable tel quel
+@st.cache_resource(ttl=30, show_spinner=False, hash_funcs=CACHE_HASH)
+def _fetch_user(conn, username: str) -> sqlite3.Row | None:
+    return conn.execute(SQL_USER, (username,)).fetchone()
 
 
+# Délai mini entre deux essais après un mot de passe incorrect (par session) :
+# évite de relancer bcrypt sur des clics répétés.
+LOGIN_RETRY_DELAY_S = 2.0
+
+
+# Fragments (appelés dans `with st.sidebar`) : un clic dans la barre latérale
+# ne relance que le bloc connexion, pas les requêtes des sections.
+@st.fragment
 def login_ui(conn):
-    st.sidebar.subheader("Connexion")
-    username = st.sidebar.text_input("Utilisateur", key="login_username")
-    password = st.sidebar.text_input("Mot de passe", type="password", key="login_password")
-    if st.sidebar.button("Se connecter", use_container_width=True):
+    st.subheader("Connexion")
+    username = st.text_input("Utilisateur", key="login_username")
+    password = st.text_input("Mot de passe", type="password", key="login_password")
+    if st.button("Se connecter", use_container_width=True):
         u = _fetch_user(conn, username.strip())
         if not u or int(u["is_active"]) != 1:
-            st.sidebar.error("Compte introuvable ou inactif.")
+            st.error("Compte introuvable ou inactif.")
+            return
+        fails = st.session_state.setdefault("_login_fail_cache", {})
+        now = time.monotonic()
+        if now - fails.get(u["username"], float("-inf")) < LOGIN_RETRY_DELAY_S:
+            st.error("Trop de tentatives, réessayez dans un instant.")
             return
         if not verify_password(password, u["password_hash"]):
-            st.sidebar.error("Mot de passe incorrect.")
+            fails[u["username"]] = now
+            st.error("Mot de passe incorrect.")
             return
+        fails.pop(u["username"], None)
         st.session_state.user = {
             "id": int(u["id"]),
             "username": u["username"],
             "role": u["role"],
             "full_name": u["full_name"],
         }
+        _reset_rbac_scope()
+        _rbac_scope(conn)
         st.rerun()
 
     if load_settings().env == "local":
-        with st.sidebar.expander("Aide / Comptes démo", expanded=True):
+        with st.expander("Aide / Comptes démo", expanded=True):
             st.markdown(
                 """
 **Comptes démo (chargés automatiquement au 1er lancement)**
@@ -76,13 +203,18 @@ def login_ui(conn):
 
 
 
+@st.fragment
 def logout_ui():
     u = st.session_state.get("user")
     if not u:
         return
-    st.sidebar.caption(f"Connecté : **{u['full_name']}** ({u['role']})")
-    if st.sidebar.button("Se déconnecter", use_container_width=True):
+    st.caption(f"Connecté : **{u['full_name']}** ({u['role']})")
+    if st.button("Actualiser", use_container_width=True, key="btn_refresh_rbac"):
+        _reset_rbac_scope()
+        st.rerun()
+    if st.button("Se déconnecter", use_container_width=True):
         st.session_state.pop("user", None)
+        _reset_rbac_scope()
         st.rerun()
 
 
@@ -105,44 +237,40 @@ def is_admin():
     return role() == "ADMIN"
 
 
+def _rbac_frames(conn) -> dict[str, pd.DataFrame]:
+    """Tables RBAC en DataFrames (via df_query : cache partagé, vidé à chaque écriture)."""
+    df = df_query(conn, SQL_RBAC)
+    return {
+        kind: df.loc[df["kind"] == kind, ["a", "b"]].set_axis(cols, axis=1)
+        for kind, cols in RBAC_COLUMNS.items()
+    }
+
+
+def _ids(s: pd.Series) -> set[int]:
+    return set(s.astype(int).tolist())
+
+
 def _mission_ids_for_user(conn) -> list[int]:
     """Liste des missions visibles selon RBAC."""
     u = st.session_state["user"]
     r = u["role"]
     uid = u["id"]
 
+    f = _rbac_frames(conn)
+    df_m = f["missions"]
+    active = _ids(df_m.loc[df_m["is_active"] == 1, "id"])
+
     if r in ("ADMIN", "BOARD"):
-        rows = conn.execute("SELECT id FROM missions WHERE is_active=1").fetchall()
-        return [int(x["id"]) for x in rows]
+        return sorted(active)
 
     if r == "LEAD":
-        rows = conn.execute(
-            """
-            SELECT m.id
-            FROM missions m
-            JOIN mission_leads ml ON ml.mission_id = m.id
-            WHERE m.is_active=1 AND ml.user_id=?
-            """,
-            (uid,),
-        ).fetchall()
-        return [int(x["id"]) for x in rows]
+        df_l = f["leads"]
+        return sorted(active & _ids(df_l.loc[df_l["user_id"] == uid, "mission_id"]))
 
     # CONSULTANT: missions assignées OU sur lesquelles il a saisi du temps
-    rows = conn.execute(
-        """
-        SELECT DISTINCT m.id
-        FROM missions m
-        LEFT JOIN mission_assignments ma ON ma.mission_id=m.id
-        LEFT JOIN time_entries te ON te.mission_id=m.id
-        WHERE m.is_active=1
-          AND (
-            ma.user_id=?
-            OR te.user_id=?
-          )
-        """,
-        (uid, uid),
-    ).fetchall()
-    return [int(x["id"]) for x in rows]
+    df_ma, df_te = f["assign"], f["time"]
+    mine = _ids(df_ma.loc[df_ma["user_id"] == uid, "mission_id"]) | _ids(df_te.loc[df_te["user_id"] == uid, "mission_id"])
+    return sorted(active & mine)
 
 
 def _visible_user_ids(conn, mission_ids: list[int]) -> list[int]:
@@ -151,30 +279,43 @@ def _visible_user_ids(conn, mission_ids: list[int]) -> list[int]:
     r = u["role"]
     uid = u["id"]
 
+    if r == "CONSULTANT":
+        return [uid]
+
+    f = _rbac_frames(conn)
+    df_u = f["users"]
+    active = _ids(df_u.loc[df_u["is_active"] == 1, "id"])
+
     if r in ("ADMIN", "BOARD"):
-        rows = conn.execute("SELECT id FROM users WHERE is_active=1").fetchall()
-        return [int(x["id"]) for x in rows]
+        return sorted(active)
+
+    # LEAD : personnes affectées ou ayant saisi du temps sur ses missions
+    if not mission_ids:
+        return [uid]
+    mset = set(mission_ids)
+    df_ma, df_te = f["assign"], f["time"]
+    linked = _ids(df_ma.loc[df_ma["mission_id"].isin(mset), "user_id"]) | _ids(df_te.loc[df_te["mission_id"].isin(mset), "user_id"])
+    return sorted((active & linked) | {uid})
 
-    if r == "LEAD":
-        if not mission_ids:
-            return [uid]
-        q = f"""
-        SELECT DISTINCT u.id
-        FROM users u
-        LEFT JOIN mission_assignments ma ON ma.user_id=u.id
-        LEFT JOIN time_entries te ON te.user_id=u.id
-        WHERE u.is_active=1
-          AND (
-            (ma.mission_id IN ({",".join(["?"]*len(mission_ids))}))
-            OR (te.mission_id IN ({",".join(["?"]*len(mission_ids))}))
-          )
-        """
-        rows = conn.execute(q, tuple(mission_ids + mission_ids)).fetchall()
-        ids = sorted({int(x["id"]) for x in rows} | {uid})
-        return ids
 
-    # CONSULTANT
-    return [uid]
+def _rbac_scope(conn) -> tuple[list[int], list[int]]:
+    """(missions visibles, users visibles), calculés une fois par session et par (user, rôle)."""
+    u = st.session_state.get("user") or {}
+    key = ("rbac_v1", u.get("id"), u.get("role"))
+    if st.session_state.get("rbac_key") != key:
+        # Changement d'utilisateur / de rôle : périmètre recalculé
+        _reset_rbac_scope()
+        st.session_state["rbac_key"] = key
+    if "mission_ids" not in st.session_state:
+        st.session_state["mission_ids"] = _mission_ids_for_user(conn)
+    if "visible_user_ids" not in st.session_state:
+        st.session_state["visible_user_ids"] = _visible_user_ids(conn, st.session_state["mission_ids"])
+    return st.session_state["mission_ids"], st.session_state["visible_user_ids"]
+
+
+def _reset_rbac_scope():
+    st.session_state.pop("mission_ids", None)
+    st.session_state.pop("visible_user_ids", None)
 
 
 # =========================
@@ -182,80 +323,230 @@ def _visible_user_ids(conn, mission_ids: list[int]) -> list[int]:
 # =========================
 
 def _today():
-    return date.today()
-
-
-def _week_bounds(d: date):
-    start = d - timedelta(days=d.weekday())
-    end = start + timedelta(days=6)
-    return start, end
+    # Une seule lecture d'horloge par exécution du script (remis à zéro dans main())
+    if "_today_cached" not in st.session_state:
+        st.session_state["_today_cached"] = date.today()
+    return st.session_state["_today_cached"]
 
 
-def _parse_ymd(s: str) -> date:
-    return datetime.strptime(s, "%Y-%m-%d").date()
+@lru_cache(maxsize=4096)
+def _month_bounds(d: date):
+    return date(d.year, d.month, 1), date(d.year, d.month, monthrange(d.year, d.month)[1])
 
 
 # =========================
 # Data access (pandas)
 # =========================
 
-def df_query(conn, sql: str, params=()):
-    return pd.read_sql_query(sql, conn, params=params)
+@st.cache_data(ttl=60, show_spinner=False, hash_funcs=CACHE_HASH)
+def df_query(conn, sql: str, params=(), arrow: bool = False):
+    cols, rows = fetch_tuples(conn, sql, tuple(params))
+    if arrow and rows:
+        # Tableaux d'affichage : colonnes Arrow (sérialisées telles quelles par st.dataframe).
+        # SQLite est typé dynamiquement : colonne hétérogène => repli numpy.
+        try:
+            table = pa.Table.from_arrays([pa.array(c) for c in zip(*rows)], names=cols)
+            return table.to_pandas(types_mapper=pd.ArrowDtype)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+    return pd.DataFrame.from_records(rows, columns=cols, coerce_float=True)
+
+
+@st.cache_data(ttl=60, show_spinner=False, hash_funcs=CACHE_HASH)
+def row_query(conn, sql: str, params=()) -> dict:
+    """Agrégat mono-ligne : dict direct depuis fetchone(), sans DataFrame."""
+    cur = conn.execute(sql, tuple(params))
+    row = cur.fetchone()
+    return dict(zip([d[0] for d in cur.description], row)) if row else {}
+
+
+@st.cache_data(ttl=300, show_spinner=False, hash_funcs=CACHE_HASH)
+def options_query(conn, sql: str, params=()) -> list[tuple]:
+    """Listes de sélection (id, libellé) : tuples bruts, sans DataFrame."""
+    return fetch_tuples(conn, sql, tuple(params))[1]
+
+
+# Liste d'ids passée en un seul paramètre JSON : même texte SQL quelle que soit
+# la taille de la liste (cache de requêtes préparées sqlite3)
+IN_IDS = "IN (SELECT value FROM json_each(?))"
+
+
+def _ids_param(ids) -> str:
+    """Ids triés sérialisés en JSON : paramètre de IN_IDS et clé de cache stable."""
+    return json.dumps(sorted(int(i) for i in ids), separators=(",", ":"))
+
+
+def _clean_lines(df_lines: pd.DataFrame, cols: list[str], defaults: dict) -> pd.DataFrame:
+    """Lignes d'éditeur prêtes à insérer : vides/NaN -> default (ou None), lignes entièrement vides retirées."""
+    clean = df_lines.reindex(columns=cols).astype(object)
+    clean = clean.where(clean.notna() & clean.ne(""), None)
+    for c, v in defaults.items():
+        if c in clean.columns:
+            clean[c] = clean[c].where(clean[c].notna(), v)
+    empty = clean.isna() | clean.isin(["", 0])
+    return clean.loc[~empty.all(axis=1)]
+
+
+def clear_query_cache():
+    """À appeler après toute écriture en base (lectures mises en cache)."""
+    df_query.clear()
+    row_query.clear()
+    options_query.clear()
+    _fetch_user.clear()
+    _reset_rbac_scope()
+
+
+# Chargeurs KPI par vue : clé normalisée (ids triés + bornes ISO) pour partager
+# l'entrée df_query entre sections ; invalidés avec clear_query_cache().
+def _load_mission_hours(conn, mids) -> pd.DataFrame:
+    return df_query(
+        conn,
+        f"""
+        SELECT client_name, mission_code, mission_name, status,
+               start_date, end_date,
+               sold_days, sold_hours, consumed_hours, consumed_pct
+        FROM kpi_mission_hours
+        WHERE mission_id {IN_IDS}
+        ORDER BY client_name, mission_code
+        """,
+        (_ids_param(mids),),
+        arrow=True,
+    )
+
+
+def _load_finance_mission(conn, mids) -> pd.DataFrame:
+    return df_query(
+        conn,
+        f"""
+        SELECT client_name, mission_code, mission_name, sold_amount_eur, cost_eur, margin_eur
+        FROM kpi_finance_mission
+        WHERE mission_id {IN_IDS}
+        ORDER BY client_name, mission_code
+        """,
+        (_ids_param(mids),),
+        arrow=True,
+    )
+
+
+def _load_mission_totals(conn, mids) -> dict:
+    return row_query(
+        conn,
+        f"""
+        SELECT
+          COUNT(*) AS missions_count,
+          SUM(consumed_hours) AS consumed_hours,
+          SUM(sold_hours) AS sold_hours
+        FROM kpi_mission_hours
+        WHERE mission_id {IN_IDS}
+        """,
+        (_ids_param(mids),),
+    )
+
+
+def _load_finance_totals(conn, mids) -> dict:
+    return row_query(
+        conn,
+        f"""
+        SELECT
+          SUM(sold_amount_eur) AS sold_amount_eur,
+          SUM(cost_eur) AS cost_eur,
+          SUM(margin_eur) AS margin_eur
+        FROM kpi_finance_mission
+        WHERE mission_id {IN_IDS}
+        """,
+        (_ids_param(mids),),
+    )
+
+
+def _load_alert_missions(conn, mids) -> pd.DataFrame:
+    return df_query(
+        conn,
+        f"""
+        SELECT mission_code, mission_name, client_name,
+               sold_hours, consumed_hours, variance_hours, risk_level
+        FROM kpi_alert_missions_risk
+        WHERE mission_id {IN_IDS}
+        ORDER BY
+          CASE risk_level
+            WHEN 'overrun' THEN 3
+            WHEN 'near_limit' THEN 2
+            WHEN 'no_sold_load' THEN 1
+            ELSE 0
+          END DESC,
+          variance_hours DESC
+        """,
+        (_ids_param(mids),),
+        arrow=True,
+    )
+
+
+def _load_capacity_daily(conn, user_ids, start_iso: str, end_iso: str) -> pd.DataFrame:
+    """Grille utilisateurs × jours : capacité (8h ou override), charge loggée et écart, calculés en SQL."""
+    return df_query(
+        conn,
+        SQL_USER_CAPACITY_DAILY,
+        (start_iso, end_iso, _ids_param(user_ids)),
+    )
+
+
+# Listes des selectbox : libellé -> id
+def _active_user_map(conn) -> dict[str, int]:
+    rows = options_query(conn, "SELECT id, full_name FROM users WHERE is_active=1 ORDER BY full_name")
+    return {label: uid for uid, label in rows}
+
+
+def _user_map(conn, user_ids) -> dict[str, int]:
+    rows = options_query(
+        conn,
+        f"SELECT id, full_name FROM users WHERE id {IN_IDS} ORDER BY full_name",
+        (_ids_param(user_ids),),
+    )
+    return {label: uid for uid, label in rows}
+
+
+def _mission_map(conn, mids) -> dict[str, int]:
+    rows = options_query(
+        conn,
+        f"SELECT mission_id, mission_code || ' — ' || mission_name AS label FROM kpi_mission_hours "
+        f"WHERE mission_id {IN_IDS} ORDER BY label",
+        (_ids_param(mids),),
+    )
+    return {label: mid for mid, label in rows}
 
 
 # =========================
 # UI Sections
 # =========================
+# Sections de consultation en fragments : un widget de la section ne relance
+# qu'elle (ni sidebar ni bootstrap). Leurs écritures valident elles-mêmes.
 
+@st.fragment
 def section_missions(conn):
     st.header("Missions")
 
-    mids = _mission_ids_for_user(conn)
+    mids, _ = _rbac_scope(conn)
     if not mids:
         st.info("Aucune mission visible.")
         return
 
-    q = f"""
-    SELECT *
-    FROM kpi_mission_hours
-    WHERE mission_id IN ({",".join(["?"]*len(mids))})
-    ORDER BY client_name, mission_code
-    """
-    df = df_query(conn, q, tuple(mids))
-
-    # Détails sans finance par défaut
-    cols = [
-        "client_name", "mission_code", "mission_name", "status",
-        "start_date", "end_date",
-        "sold_days", "sold_hours", "consumed_hours", "consumed_pct",
-    ]
-
-    st.dataframe(df[cols], use_container_width=True, hide_index=True)
+    # Détails sans finance par défaut (colonnes projetées par le chargeur)
+    df = _load_mission_hours(conn, mids)
+    st.dataframe(df, use_container_width=True, hide_index=True)
 
     # Board/Admin: bloc finance
     if is_board():
         st.subheader("Financier (Board/Admin)")
-        qf = f"""
-        SELECT *
-        FROM kpi_finance_mission
-        WHERE mission_id IN ({",".join(["?"]*len(mids))})
-        ORDER BY client_name, mission_code
-        """
-        dff = df_query(conn, qf, tuple(mids))
-        st.dataframe(
-            dff[["client_name","mission_code","mission_name","sold_amount_eur","cost_eur","margin_eur"]],
-            use_container_width=True,
-            hide_index=True,
-        )
+        dff = _load_finance_mission(conn, mids)
+        st.dataframe(dff, use_container_width=True, hide_index=True)
     else:
         st.caption("Financier masqué (Board uniquement).")
 
 
+@st.fragment
 def section_cra(conn):
     st.header("Temps / CRA")
 
-    mids = _mission_ids_for_user(conn)
-    visible_users = _visible_user_ids(conn, mids)
+    mids, visible_users = _rbac_scope(conn)
 
     # Filtres période
     view = st.radio("Vue", ["Jour", "Semaine", "Mois"], horizontal=True)
@@ -266,13 +557,10 @@ def section_cra(conn):
         start, end = d0, d0
     elif view == "Semaine":
         d0 = st.date_input("Semaine (date incluse)", value=base)
-        start, end = _week_bounds(d0)
+        start, end = week_bounds(d0)
     else:
         d0 = st.date_input("Mois (date incluse)", value=base)
-        start = date(d0.year, d0.month, 1)
-        # fin de mois
-        next_month = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
-        end = next_month - timedelta(days=1)
+        start, end = _month_bounds(d0)
 
     st.caption(f"Période : {start} → {end}")
 
@@ -284,9 +572,9 @@ def section_cra(conn):
             entry_date = st.date_input("Date", value=base)
             if role() == "ADMIN":
                 # admin peut saisir pour un autre (utile demo)
-                users_df = df_query(conn, "SELECT id, full_name FROM users WHERE is_active=1 ORDER BY full_name")
-                user_label = st.selectbox("Utilisateur", users_df["full_name"].tolist())
-                user_id = int(users_df.loc[users_df["full_name"] == user_label, "id"].iloc[0])
+                user_map = _active_user_map(conn)
+                user_label = st.selectbox("Utilisateur", list(user_map))
+                user_id = user_map[user_label]
             else:
                 user_id = st.session_state["user"]["id"]
 
@@ -295,18 +583,11 @@ def section_cra(conn):
             desc = st.text_input("Description (optionnel)")
 
             # missions visibles + option "Aucune" (pour internal)
-            missions_df = df_query(
-                conn,
-                f"SELECT mission_id AS id, mission_code || ' — ' || mission_name AS label FROM kpi_mission_hours "
-                f"WHERE mission_id IN ({','.join(['?']*len(mids))}) ORDER BY label",
-                tuple(mids),
-            )
+            mission_map = _mission_map(conn, mids)
 
-            labels = ["(aucune)"] + missions_df["label"].tolist()
+            labels = ["(aucune)"] + list(mission_map)
             mission_pick = st.selectbox("Mission", labels, help="Laisser (aucune) pour internal.")
-            mission_id = None
-            if mission_pick != "(aucune)":
-                mission_id = int(missions_df.loc[missions_df["label"] == mission_pick, "id"].iloc[0])
+            mission_id = mission_map.get(mission_pick)
 
             submitted = st.form_submit_button("Enregistrer", use_container_width=True)
             if submitted:
@@ -318,18 +599,20 @@ def section_cra(conn):
                         st.stop()
 
                 try:
-                    conn.execute(
-                        """INSERT OR IGNORE INTO time_entries(entry_date, user_id, mission_id, category, hours, description)
-                           VALUES (?, ?, ?, ?, ?, ?)""",
-                        (entry_date.isoformat(), user_id, mission_id, category, int(hours), desc or None),
-                    )
+                    # Fragment : pas de commit / rollback de main(), tx() valide ou annule ici
+                    with tx(conn):
+                        conn.execute(
+                            """INSERT OR IGNORE INTO time_entries(entry_date, user_id, mission_id, category, hours, description)
+                               VALUES (?, ?, ?, ?, ?, ?)""",
+                            (entry_date.isoformat(), user_id, mission_id, category, int(hours), desc or None),
+                        )
+                    clear_query_cache()
                     st.success("Saisie enregistrée (ou ignorée si doublon).")
                 except Exception as e:
                     st.error(f"Erreur insertion : {e}")
 
     # Vue liste (RBAC)
-    q_users = ",".join(["?"] * len(visible_users))
-    params = tuple(visible_users) + (start.isoformat(), end.isoformat())
+    params = (_ids_param(visible_users), start.isoformat(), end.isoformat())
 
     df = df_query(
         conn,
@@ -345,99 +628,54 @@ def section_cra(conn):
         FROM time_entries te
         JOIN users u ON u.id=te.user_id
         LEFT JOIN missions m ON m.id=te.mission_id
-        WHERE te.user_id IN ({q_users})
+        WHERE te.user_id {IN_IDS}
           AND te.entry_date BETWEEN ? AND ?
         ORDER BY te.entry_date DESC, user_name
         """,
         params,
+        arrow=True,
     )
     st.subheader("Historique")
     st.dataframe(df, use_container_width=True, hide_index=True)
 
 
+@st.fragment
 def section_capacites(conn):
     st.header("Capacités")
 
-    mids = _mission_ids_for_user(conn)
-    user_ids = _visible_user_ids(conn, mids)
+    mids, user_ids = _rbac_scope(conn)
 
     # Période: semaine courante
     view = st.radio("Vue", ["Semaine", "Mois"], horizontal=True)
     d0 = st.date_input("Date de référence", value=_today())
 
     if view == "Semaine":
-        start, end = _week_bounds(d0)
+        start, end = week_bounds(d0)
     else:
-        start = date(d0.year, d0.month, 1)
-        next_month = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
-        end = next_month - timedelta(days=1)
+        start, end = _month_bounds(d0)
 
 
-    # Charges loggées
-    q_users = ",".join(["?"] * len(user_ids))
-    df_load = df_query(
-        conn,
-        f"""
-        SELECT day, user_id, user_name, logged_hours
-        FROM kpi_user_load_daily
-        WHERE user_id IN ({q_users})
-          AND day BETWEEN ? AND ?
-        """,
-        tuple(user_ids) + (start.isoformat(), end.isoformat()),
-    )
-
-    # Capacité: 8h/j par défaut + overrides
-    users_df = df_query(
-        conn,
-        f"SELECT id AS user_id, full_name AS user_name FROM users WHERE id IN ({q_users}) ORDER BY full_name",
-        tuple(user_ids),
-    )
-
-    nb_days = (end - start).days + 1
-    days = [(start + timedelta(days=i)).isoformat() for i in range(nb_days)]
-
-    cap_rows = []
-    for _, u in users_df.iterrows():
-        for day in days:
-            ov = conn.execute(
-                "SELECT capacity_h FROM capacity_overrides WHERE user_id=? AND cap_date=?",
-                (int(u["user_id"]), day),
-            ).fetchone()
-            cap_h = int(ov["capacity_h"]) if ov else 8
-            cap_rows.append({"day": day, "user_id": int(u["user_id"]), "user_name": u["user_name"], "capacity_h": cap_h})
-
-    df_cap = pd.DataFrame(cap_rows)
-
-    # Merge + synthèse
-    dfm = df_cap.merge(df_load, on=["day", "user_id", "user_name"], how="left").fillna({"logged_hours": 0})
-    dfm["delta_h"] = dfm["capacity_h"] - dfm["logged_hours"]
+    # Capacité (8h/j par défaut + overrides) et charges loggées, jointes en SQL
+    dfm = _load_capacity_daily(conn, user_ids, start.isoformat(), end.isoformat())
 
     st.caption(f"Période : {start} → {end}")
     st.subheader("Modifier capacité (override)")
     if role() in ("ADMIN", "LEAD"):
-        users_df2 = df_query(
-            conn,
-            f"SELECT id AS user_id, full_name AS user_name FROM users WHERE id IN ({q_users}) ORDER BY full_name",
-            tuple(user_ids),
-        )
+        user_map = _user_map(conn, user_ids)
         with st.form("cap_override", clear_on_submit=True):
-            u_label = st.selectbox("Utilisateur", users_df2["user_name"].tolist())
-            uid = int(users_df2.loc[users_df2["user_name"] == u_label, "user_id"].iloc[0])
+            u_label = st.selectbox("Utilisateur", list(user_map))
+            uid = user_map[u_label]
             cap_date = st.date_input("Date")
             cap_h = st.number_input("Capacité (heures)", min_value=0, max_value=24, value=8, step=1)
             reason = st.text_input("Raison (optionnel)")
             submitted = st.form_submit_button("Enregistrer override", use_container_width=True)
             if submitted:
-                conn.execute(
-                    """
-                    INSERT INTO capacity_overrides(user_id, cap_date, capacity_h, reason)
-                    VALUES (?, ?, ?, ?)
-                    ON CONFLICT(user_id, cap_date) DO UPDATE SET
-                      capacity_h=excluded.capacity_h,
-                      reason=excluded.reason
-                    """,
-                    (uid, cap_date.isoformat(), int(cap_h), (reason.strip() if reason and reason.strip() else None)),
-                )
+                with tx(conn):
+                    conn.execute(
+                        SQL_UPSERT_CAPACITY,
+                        (uid, cap_date.isoformat(), int(cap_h), (reason.strip() if reason and reason.strip() else None)),
+                    )
+                clear_query_cache()
                 st.success("Override enregistré.")
                 st.rerun()
     else:
@@ -451,19 +689,24 @@ def section_capacites(conn):
 
     st.subheader("Résumé semaine")
     summary = (
-        dfm.groupby(["user_id", "user_name"], as_index=False)
-        .agg(capacity_h=("capacity_h", "sum"), logged_hours=("logged_hours", "sum"), delta_h=("delta_h", "sum"))
+        dfm.groupby("user_id", sort=False, as_index=False)
+        .agg(
+            user_name=("user_name", "first"),
+            capacity_h=("capacity_h", "sum"),
+            logged_hours=("logged_hours", "sum"),
+            delta_h=("delta_h", "sum"),
+        )
         .sort_values("user_name")
     )
     st.dataframe(summary, use_container_width=True, hide_index=True)
 
 
+@st.fragment
 def section_alertes(conn):
     st.header("Alertes")
 
     # périmètres
-    mids = _mission_ids_for_user(conn)
-    visible_user_ids = _visible_user_ids(conn, mids if mids else [])
+    mids, visible_user_ids = _rbac_scope(conn)
 
     tab_m, tab_c = st.tabs(["Missions", "Capacités"])
 
@@ -476,21 +719,7 @@ def section_alertes(conn):
         if not mids:
             st.info("Aucune mission visible.")
         else:
-            q = f"""
-            SELECT mission_code, mission_name, client_name,
-                   sold_hours, consumed_hours, variance_hours, risk_level
-            FROM kpi_alert_missions_risk
-            WHERE mission_id IN ({",".join(["?"]*len(mids))})
-            ORDER BY
-              CASE risk_level
-                WHEN 'overrun' THEN 3
-                WHEN 'near_limit' THEN 2
-                WHEN 'no_sold_load' THEN 1
-                ELSE 0
-              END DESC,
-              variance_hours DESC
-            """
-            df = df_query(conn, q, tuple(mids))
+            df = _load_alert_missions(conn, mids)
 
             if df.empty:
                 st.success("Aucune alerte mission détectée sur votre périmètre.")
@@ -506,8 +735,6 @@ def section_alertes(conn):
         if not visible_user_ids:
             st.info("Aucun utilisateur visible pour les alertes capacité.")
         else:
-            u_sql = ",".join(["?"] * len(visible_user_ids))
-
             sub_d, sub_w = st.tabs(["Jour", "Semaine"])
 
             with sub_d:
@@ -516,10 +743,11 @@ def section_alertes(conn):
                     f"""
                     SELECT day, user_name, capacity_h, logged_hours, over_h
                     FROM kpi_alert_capacity_daily
-                    WHERE user_id IN ({u_sql})
-                    ORDER BY day DESC, over_h DESC
+                    WHERE user_id {IN_IDS}
+                    ORDER BY day DESC, over_h DESC, user_id
                     """,
-                    tuple(visible_user_ids),
+                    (_ids_param(visible_user_ids),),
+                    arrow=True,
                 )
                 if dfc.empty:
                     st.success("Aucune surcapacité journalière détectée.")
@@ -533,10 +761,11 @@ def section_alertes(conn):
                     SELECT year, week, week_start_day, week_end_day,
                            user_name, capacity_h, logged_hours, over_h
                     FROM kpi_alert_capacity_weekly
-                    WHERE user_id IN ({u_sql})
+                    WHERE user_id {IN_IDS}
                     ORDER BY year DESC, week DESC, over_h DESC
                     """,
-                    tuple(visible_user_ids),
+                    (_ids_param(visible_user_ids),),
+                    arrow=True,
                 )
                 if dfw.empty:
                     st.success("Aucune surcapacité hebdomadaire détectée.")
@@ -545,24 +774,17 @@ def section_alertes(conn):
 
 
 
+@st.fragment
 def section_synthese(conn):
     st.header("Synthèse")
 
-    mids = _mission_ids_for_user(conn)
+    mids, visible_user_ids = _rbac_scope(conn)
     if not mids:
         st.info("Aucune mission visible.")
         return
 
     # KPI cards (déjà existant)
-    q = f"""
-    SELECT
-      COUNT(*) AS missions_count,
-      SUM(consumed_hours) AS consumed_hours,
-      SUM(sold_hours) AS sold_hours
-    FROM kpi_mission_hours
-    WHERE mission_id IN ({",".join(["?"]*len(mids))})
-    """
-    k = df_query(conn, q, tuple(mids)).iloc[0].to_dict()
+    k = _load_mission_totals(conn, mids)
     missions_count = int(k.get("missions_count") or 0)
     consumed_hours = float(k.get("consumed_hours") or 0)
     sold_hours = float(k.get("sold_hours") or 0)
@@ -575,15 +797,7 @@ def section_synthese(conn):
 
     if is_board():
         st.subheader("Synthèse financière (Board/Admin)")
-        qf = f"""
-        SELECT
-          SUM(sold_amount_eur) AS sold_amount_eur,
-          SUM(cost_eur) AS cost_eur,
-          SUM(margin_eur) AS margin_eur
-        FROM kpi_finance_mission
-        WHERE mission_id IN ({",".join(["?"]*len(mids))})
-        """
-        fin = df_query(conn, qf, tuple(mids)).iloc[0].to_dict()
+        fin = _load_finance_totals(conn, mids)
         f1, f2, f3 = st.columns(3)
         f1.metric("CA vendu", f"{float(fin.get('sold_amount_eur') or 0):,.0f} €".replace(",", " "))
         f2.metric("Coûts estimés", f"{float(fin.get('cost_eur') or 0):,.0f} €".replace(",", " "))
@@ -594,21 +808,29 @@ def section_synthese(conn):
         SELECT simulation_id, client_name, project_name, mission_id, status, created_at,
                 revenue_total, cost_total, margin_total, margin_pct
         FROM kpi_simulation_summary
-        WHERE mission_id IN ({",".join(["?"]*len(mids))})
+        WHERE mission_id {IN_IDS}
             AND status != 'archived'
         ORDER BY datetime(created_at) DESC
         """
-        sims_df = df_query(conn, qs, tuple(mids))
+        sims_df = df_query(conn, qs, (_ids_param(mids),), arrow=True)
         if sims_df.empty:
             st.caption("Aucune simulation liée aux missions visibles.")
         else:
             st.dataframe(sims_df, use_container_width=True, hide_index=True)
 
     st.divider()
+    chatbot_ui(conn, mids, visible_user_ids)
+
+
+# Fragment : une question au chatbot ne relance pas les KPI / finance de la page
+@st.fragment
+def chatbot_ui(conn, mids: list[int], visible_user_ids: list[int]):
     st.subheader("Chatbot (lecture seule)")
 
+    # Import différé : le module chatbot n'est chargé que sur cette page
+    from src.services.chatbot import ChatContext, answer_question
+
     # Contexte RBAC
-    visible_user_ids = _visible_user_ids(conn, mids)
     ctx = ChatContext(
         role=role(),
         user_id=st.session_state["user"]["id"],
@@ -641,7 +863,10 @@ def section_synthese(conn):
         ask = True
 
     if ask:
-        out = answer_question(conn, ctx, q_user)
+        # Audit chat : un rerun de fragment ne passe pas par main(), tx() valide
+        # l'écriture (ou l'annule si la réponse échoue après l'INSERT d'audit).
+        with tx(conn):
+            out = answer_question(conn, ctx, q_user)
         st.markdown(out["text"])
 
         for t in out.get("tables", []):
@@ -661,7 +886,14 @@ def section_simulation_board(conn):
         return df_query(conn, sql, params)
 
     def _get_simulation(sim_id: int):
-        r = conn.execute("SELECT * FROM simulations WHERE id=?", (sim_id,)).fetchone()
+        r = conn.execute(
+            """
+            SELECT id, mission_id, client_name, project_name, sector,
+                   start_date, end_date, status, notes
+            FROM simulations WHERE id=?
+            """,
+            (sim_id,),
+        ).fetchone()
         return dict(r) if r else None
 
     def _save_simulation_header(sim_id, payload: dict) -> int:
@@ -686,6 +918,7 @@ def section_simulation_board(conn):
                 ),
             )
             conn.commit()  # ✅ IMPORTANT
+            clear_query_cache()
             return int(cur.lastrowid)
 
         conn.execute(
@@ -708,72 +941,23 @@ def section_simulation_board(conn):
             ),
         )
         conn.commit()  # ✅ IMPORTANT
+        clear_query_cache()
         return int(sim_id)
 
     def _overwrite_lines(sim_id: int, table: str, df_lines: pd.DataFrame, cols: list[str], defaults=None):
-        if sim_id is None:
-            st.error("Simulation introuvable en base. Enregistre d’abord l’en-tête (Client/Projet), puis réessaie.")
-            return
-
-        exists = conn.execute(
-            "SELECT 1 FROM simulations WHERE id=?",
-            (int(sim_id),),
-        ).fetchone()
-
-        if not exists:
-            st.error("Simulation introuvable en base (ID invalide). Recharge la page et réessaie.")
-            return
-
         """
         POC simple : on remplace tout (delete + insert)
         + sécurisation NOT NULL / CHECK via defaults
+        sim_id doit avoir été vérifié par l'appelant, qui porte la transaction.
         """
-        defaults = defaults or {}
-
         conn.execute(f"DELETE FROM {table} WHERE simulation_id=?", (int(sim_id),))
-
         if df_lines is None or df_lines.empty:
-            conn.commit()
-            return
-
-        clean = df_lines.copy()
-        clean = clean.replace({pd.NA: None})
-        clean = clean.where(pd.notna(clean), None)
-
-        rows = []
-        for _, r in clean.iterrows():
-            values = []
-            all_empty = True
-
-            for c in cols:
-                v = r.get(c)
-
-                # default si vide
-                if v in (None, ""):
-                    v = defaults.get(c, None)
-
-                # normaliser NaN
-                if isinstance(v, float) and pd.isna(v):
-                    v = defaults.get(c, None)
-
-                if v not in (None, "", 0, 0.0):
-                    all_empty = False
-
-                values.append(v)
-
-            if all_empty:
-                continue
-
-            rows.append([sim_id] + values)
-
-        if not rows:
-            conn.commit()
             return
-
-        placeholders = ",".join(["?"] * (1 + len(cols)))
-        sql = f"INSERT INTO {table}(simulation_id,{','.join(cols)}) VALUES ({placeholders})"
-        conn.executemany(sql, rows)
-        conn.commit()
+        clean = _clean_lines(df_lines, cols, defaults or {})
+        conn.executemany(
+            _insert_sql(table, tuple(cols)),
+            ((sim_id, *r) for r in clean.itertuples(index=False, name=None)),
+        )
 
 
 
@@ -783,7 +967,7 @@ def section_simulation_board(conn):
     sims = _df(
         """
         SELECT
-          simulation_id, mission_id, client_name, project_name, sector, status, created_at,
+          simulation_id, client_name, project_name, status, created_at,
           revenue_total, cost_total, margin_total, margin_pct
         FROM kpi_simulation_summary
         ORDER BY datetime(created_at) DESC
@@ -800,14 +984,17 @@ def section_simulation_board(conn):
             st.rerun()
 
         # Sélection
-        options = ["(aucune)"]
-        if not sims.empty:
-            options += [f"#{int(r.simulation_id)} — {r.client_name} — {r.project_name} ({r.status})" for _, r in sims.iterrows()]
+        sim_map = {
+            f"#{int(i)} — {client} — {project} ({status})": int(i)
+            for i, client, project, status in zip(
+                sims["simulation_id"], sims["client_name"], sims["project_name"], sims["status"]
+            )
+        }
+        options = ["(aucune)"] + list(sim_map)
 
         pick = st.selectbox("Ouvrir une simulation", options, key="sim_pick")
         if pick != "(aucune)":
-            sim_id = int(pick.split("—")[0].strip().replace("#", ""))
-            st.session_state["sim_selected_id"] = sim_id
+            st.session_state["sim_selected_id"] = sim_map[pick]
             st.session_state["sim_mode"] = "edit"
         if st.button("🔄 Rafraîchir", use_container_width=True, key="btn_refresh_sim"):
             st.rerun()
@@ -816,16 +1003,7 @@ def section_simulation_board(conn):
         if sims.empty:
             st.info("Aucune simulation pour le moment. Clique sur “Nouvelle simulation”.")
         else:
-            show = sims.copy()
-            # formatting friendly
-            st.dataframe(
-                show[
-                    ["simulation_id", "client_name", "project_name", "status", "created_at",
-                     "revenue_total", "cost_total", "margin_total", "margin_pct"]
-                ],
-                use_container_width=True,
-                hide_index=True,
-            )
+            st.dataframe(sims, use_container_width=True, hide_index=True)
 
     st.divider()
     st.subheader("Édition")
@@ -834,30 +1012,24 @@ def section_simulation_board(conn):
     sim = _get_simulation(sim_id) if sim_id else None
 
     # ---- Header editor
-    missions = _df(
+    missions = options_query(
+        conn,
         """
-        SELECT m.id, c.name AS client, m.code, m.name
+        SELECT m.id, c.name || ' — ' || m.code || ' — ' || m.name AS label
         FROM missions m
         JOIN clients c ON c.id=m.client_id
         WHERE m.is_active=1
         ORDER BY c.name, m.code
-        """
+        """,
     )
-    mission_labels = ["(devis — sans mission)"]
-    mission_map = {mission_labels[0]: None}
-    for _, r in missions.iterrows():
-        lbl = f"{r['client']} — {r['code']} — {r['name']}"
-        mission_labels.append(lbl)
-        mission_map[lbl] = int(r["id"])
+    mission_map = {"(devis — sans mission)": None}
+    mission_map.update((label, mid) for mid, label in missions)
+    mission_labels = list(mission_map)
 
     default_label = mission_labels[0]
     if sim and sim.get("mission_id"):
-        # find label
-        mid = int(sim["mission_id"])
-        for lbl, v in mission_map.items():
-            if v == mid:
-                default_label = lbl
-                break
+        label_by_id = {v: lbl for lbl, v in mission_map.items()}
+        default_label = label_by_id.get(int(sim["mission_id"]), default_label)
 
     with st.form("sim_header_form", clear_on_submit=False):
         c1, c2, c3 = st.columns(3)
@@ -1014,57 +1186,62 @@ def section_simulation_board(conn):
     with colS1:
         if st.button("💾 Enregistrer lignes", use_container_width=True, type="primary", key=f"btn_save_lines_{sim_id}"):
             # Garde-fou FK : la simulation doit exister
-            exists = conn.execute("SELECT 1 FROM simulations WHERE id=?", (int(sim_id),)).fetchone()
+            exists = conn.execute(SQL_SIM_EXISTS, (int(sim_id),)).fetchone()
             if not exists:
                 st.error("Simulation introuvable en base. Enregistre d’abord l’en-tête (Client/Projet), puis réessaie.")
                 st.stop()
 
-            _overwrite_lines(
-                int(sim_id),
-                "simulation_internal_resources",
-                df_int_edit,
-                ["resource_name", "grade", "std_rate_per_hour", "std_cost_per_hour", "planned_days", "hours_per_day", "billable_ratio", "non_billable_hours"],
-                defaults={
-                    "std_rate_per_hour": 0.0,
-                    "std_cost_per_hour": 0.0,
-                    "planned_days": 0.0,
-                    "hours_per_day": 8.0,
-                    "billable_ratio": 1.0,
-                    "non_billable_hours": 0.0,
-                },
-            )
+            # Garde-fou vérifié une seule fois ; les 3 tables dans une même transaction
+            # (verrou d'écriture pris d'emblée : pas d'échec SQLITE_BUSY en cours de route)
+            with tx(conn):
+                _overwrite_lines(
+                    int(sim_id),
+                    "simulation_internal_resources",
+                    df_int_edit,
+                    ["resource_name", "grade", "std_rate_per_hour", "std_cost_per_hour", "planned_days", "hours_per_day", "billable_ratio", "non_billable_hours"],
+                    defaults={
+                        "std_rate_per_hour": 0.0,
+                        "std_cost_per_hour": 0.0,
+                        "planned_days": 0.0,
+                        "hours_per_day": 8.0,
+                        "billable_ratio": 1.0,
+                        "non_billable_hours": 0.0,
+                    },
+                )
 
-            _overwrite_lines(
-                int(sim_id),
-                "simulation_external_resources",
-                df_ext_edit,
-                ["provider_name", "role", "buy_rate_per_day", "sell_rate_per_day", "planned_days", "hours_per_day"],
-                defaults={
-                    "buy_rate_per_day": 0.0,
-                    "sell_rate_per_day": 0.0,
-                    "planned_days": 0.0,
-                    "hours_per_day": 8.0,
-                },
-            )
+                _overwrite_lines(
+                    int(sim_id),
+                    "simulation_external_resources",
+                    df_ext_edit,
+                    ["provider_name", "role", "buy_rate_per_day", "sell_rate_per_day", "planned_days", "hours_per_day"],
+                    defaults={
+                        "buy_rate_per_day": 0.0,
+                        "sell_rate_per_day": 0.0,
+                        "planned_days": 0.0,
+                        "hours_per_day": 8.0,
+                    },
+                )
 
-            _overwrite_lines(
-                int(sim_id),
-                "simulation_costs",
-                df_cost_edit,
-                ["cost_type", "label", "cost_amount", "refactured_amount"],
-                defaults={
-                    "cost_type": "expenses",  # valeur valide du CHECK
-                    "cost_amount": 0.0,
-                    "refactured_amount": 0.0,
-                },
-            )
+                _overwrite_lines(
+                    int(sim_id),
+                    "simulation_costs",
+                    df_cost_edit,
+                    ["cost_type", "label", "cost_amount", "refactured_amount"],
+                    defaults={
+                        "cost_type": "expenses",  # valeur valide du CHECK
+                        "cost_amount": 0.0,
+                        "refactured_amount": 0.0,
+                    },
+                )
 
+            clear_query_cache()
             st.success("Lignes enregistrées.")
             st.rerun()
 
     with colS2:
         if st.button("🗑️ Supprimer la simulation", use_container_width=True, key=f"btn_delete_sim_{sim_id}"):
             conn.execute("DELETE FROM simulations WHERE id=?", (int(sim_id),))
+            clear_query_cache()
             st.session_state["sim_selected_id"] = None
             st.success("Simulation supprimée.")
             st.rerun()
@@ -1072,68 +1249,66 @@ def section_simulation_board(conn):
     st.caption("POC: l’enregistrement des lignes remplace l’ensemble des lignes (delete+insert).")
 
 
-def section_admin(conn, settings):
-    st.header("Admin")
-
-    if not is_admin():
-        st.error("Accès réservé Admin.")
-        return
-
-    tab_ref, tab_data = st.tabs(["Référentiels", "Données (démo/import)"])
-
-    # ======================
-    # Référentiels: Clients & Missions
-    # ======================
-    with tab_ref:
-        st.subheader("Clients")
-        with st.form("add_client", clear_on_submit=True):
-            client_name = st.text_input("Nom du client")
-            submitted = st.form_submit_button("Ajouter client", use_container_width=True)
-            if submitted:
-                if not client_name.strip():
-                    st.error("Nom client obligatoire.")
-                else:
+# Fragment : un ajout client / mission ne relance que les référentiels ; les tableaux
+# en dessous du formulaire sont relus dans le même passage (cache invalidé par l'écriture).
+# Un rerun de fragment ne passe pas par main() : écritures dans tx() (commit, ou
+# rollback si l'insertion échoue, ex. code mission en double).
+@st.fragment
+def _admin_referentiels(conn):
+    st.subheader("Clients")
+    with st.form("add_client", clear_on_submit=True):
+        client_name = st.text_input("Nom du client")
+        submitted = st.form_submit_button("Ajouter client", use_container_width=True)
+        if submitted:
+            if not client_name.strip():
+                st.error("Nom client obligatoire.")
+            else:
+                with tx(conn):
                     conn.execute(
                         "INSERT OR IGNORE INTO clients(name, is_active) VALUES (?, 1)",
                         (client_name.strip(),),
                     )
-                    st.success("Client ajouté (ou déjà existant).")
-                    st.rerun()
+                clear_query_cache()
+                st.success("Client ajouté (ou déjà existant).")
 
-        clients_df = df_query(conn, "SELECT id, name, is_active FROM clients ORDER BY name")
-        st.dataframe(clients_df, use_container_width=True, hide_index=True)
+    clients_df = df_query(conn, "SELECT id, name, is_active FROM clients ORDER BY name", arrow=True)
+    st.dataframe(clients_df, use_container_width=True, hide_index=True)
 
-        st.divider()
-        st.subheader("Missions")
-
-        # Select client
-        clients = df_query(conn, "SELECT id, name FROM clients WHERE is_active=1 ORDER BY name")
-        if clients.empty:
-            st.info("Crée d’abord au moins un client.")
-        else:
-            with st.form("add_mission", clear_on_submit=True):
-                client_label = st.selectbox("Client", clients["name"].tolist())
-                client_id = int(clients.loc[clients["name"] == client_label, "id"].iloc[0])
+    st.divider()
+    st.subheader("Missions")
+
+    # Select client
+    client_map = {
+        name: cid
+        for cid, name in options_query(conn, "SELECT id, name FROM clients WHERE is_active=1 ORDER BY name")
+    }
+    if not client_map:
+        st.info("Crée d’abord au moins un client.")
+    else:
+        with st.form("add_mission", clear_on_submit=True):
+            client_label = st.selectbox("Client", list(client_map))
+            client_id = client_map[client_label]
 
-                code = st.text_input("Code mission (unique)", placeholder="ex: M-2026-003")
-                name = st.text_input("Nom mission", placeholder="ex: Mission DataOps")
-                status = st.selectbox("Statut", ["pipeline", "ongoing", "paused", "done", "cancelled"], index=1)
-                start_date = st.date_input("Date de début")
-                end_date = st.date_input("Date de fin (optionnel)", value=None)
+            code = st.text_input("Code mission (unique)", placeholder="ex: M-2026-003")
+            name = st.text_input("Nom mission", placeholder="ex: Mission DataOps")
+            status = st.selectbox("Statut", ["pipeline", "ongoing", "paused", "done", "cancelled"], index=1)
+            start_date = st.date_input("Date de début")
+            end_date = st.date_input("Date de fin (optionnel)", value=None)
 
-                sold_days = st.number_input("Jours vendus", min_value=0.0, value=0.0, step=1.0)
+            sold_days = st.number_input("Jours vendus", min_value=0.0, value=0.0, step=1.0)
 
-                # Champs finance (admin OK). Si tu veux les masquer à l’admin aussi, on peut.
-                sold_amount_eur = st.number_input("CA vendu (€)", min_value=0.0, value=0.0, step=1000.0)
-                daily_cost_eur = st.number_input("Coût/jour (€)", min_value=0.0, value=0.0, step=50.0)
+            # Champs finance (admin OK). Si tu veux les masquer à l’admin aussi, on peut.
+            sold_amount_eur = st.number_input("CA vendu (€)", min_value=0.0, value=0.0, step=1000.0)
+            daily_cost_eur = st.number_input("Coût/jour (€)", min_value=0.0, value=0.0, step=50.0)
 
-                notes = st.text_area("Notes (optionnel)")
-                submitted = st.form_submit_button("Ajouter mission", use_container_width=True)
+            notes = st.text_area("Notes (optionnel)")
+            submitted = st.form_submit_button("Ajouter mission", use_container_width=True)
 
-                if submitted:
-                    if not code.strip() or not name.strip():
-                        st.error("Code + nom mission obligatoires.")
-                    else:
+            if submitted:
+                if not code.strip() or not name.strip():
+                    st.error("Code + nom mission obligatoires.")
+                else:
+                    with tx(conn):
                         conn.execute(
                             """
                             INSERT INTO missions(
@@ -1154,19 +1329,35 @@ def section_admin(conn, settings):
                                 (notes.strip() if notes and notes.strip() else None),
                             ),
                         )
-                        st.success("Mission ajoutée.")
-                        st.rerun()
+                    clear_query_cache()
+                    st.success("Mission ajoutée.")
 
-        missions_df = df_query(
-            conn,
-            """
-            SELECT m.id, c.name AS client, m.code, m.name, m.status, m.start_date, m.end_date, m.sold_days, m.is_active
-            FROM missions m
-            JOIN clients c ON c.id=m.client_id
-            ORDER BY c.name, m.code
-            """,
-        )
-        st.dataframe(missions_df, use_container_width=True, hide_index=True)
+    missions_df = df_query(
+        conn,
+        """
+        SELECT m.id, c.name AS client, m.code, m.name, m.status, m.start_date, m.end_date, m.sold_days, m.is_active
+        FROM missions m
+        JOIN clients c ON c.id=m.client_id
+        ORDER BY c.name, m.code
+        """,
+    )
+    st.dataframe(missions_df, use_container_width=True, hide_index=True)
+
+
+def section_admin(conn, settings):
+    st.header("Admin")
+
+    if not is_admin():
+        st.error("Accès réservé Admin.")
+        return
+
+    tab_ref, tab_data = st.tabs(["Référentiels", "Données (démo/import)"])
+
+    # ======================
+    # Référentiels: Clients & Missions
+    # ======================
+    with tab_ref:
+        _admin_referentiels(conn)
 
     # ======================
     # Données: Reset demo + Import ZIP (existant)
@@ -1174,7 +1365,9 @@ def section_admin(conn, settings):
     with tab_data:
         st.subheader("Réinitialiser données démo")
         if st.button("Reset Démo (efface et recharge data/sample)", type="primary", key="btn_reset_demo"):
-            reset_demo(conn, settings=settings)
+            reset_demo(conn, settings=settings, sample_dir=SAMPLE_DIR)
+            clear_query_cache()
+            _bootstrap.clear()
             st.success("Données démo réinitialisées.")
             st.rerun()
 
@@ -1188,20 +1381,15 @@ def section_admin(conn, settings):
         if up is not None:
             if st.button("Importer (remplace les données)", use_container_width=True, key="btn_import_zip_1"):
                 import tempfile
+                import zipfile
                 with tempfile.TemporaryDirectory() as tmp:
-                    zbytes = io.BytesIO(up.read())
-                    with zipfile.ZipFile(zbytes) as zf:
+                    # UploadedFile est déjà un flux seekable : pas de copie intermédiaire
+                    up.seek(0)
+                    with zipfile.ZipFile(up) as zf:
                         zf.extractall(tmp)
 
-                    conn.execute("DELETE FROM time_entries;")
-                    conn.execute("DELETE FROM mission_assignments;")
-                    conn.execute("DELETE FROM mission_leads;")
-                    conn.execute("DELETE FROM missions;")
-                    conn.execute("DELETE FROM clients;")
-                    conn.execute("DELETE FROM capacity_overrides;")
-                    conn.execute("DELETE FROM users;")
-
-                    seed_from_csv(conn, settings=settings, sample_dir=Path(tmp))
+                    reset_demo(conn, settings=settings, sample_dir=Path(tmp))
+                    clear_query_cache()
 
                 st.success("Import terminé.")
                 st.rerun()
@@ -1214,6 +1402,7 @@ def section_admin(conn, settings):
 
 def main():
     st.set_page_config(page_title="Pilotage Cabinet - POC", layout="wide")
+    st.session_state.pop("_today_cached", None)
     settings = load_settings()
 
     # Pré-auth (utile si déployé sur internet)
@@ -1234,50 +1423,61 @@ def main():
                 if st.session_state.get("access_ok") is not True:
                     st.stop()
 
-    with get_conn() as conn:
-        ensure_schema(conn, settings=settings)
-        seed_demo_if_empty(conn, settings=settings)
+    _bootstrap(settings.db_path)
+    conn = _session_conn(settings.db_path)
+    try:
+        _render(conn, settings)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # st.rerun / st.stop sortent par BaseException : on valide quand même
+        if conn.in_transaction:
+            conn.commit()
+
 
-        # Sidebar auth
+def _render(conn, settings):
+    # Sidebar auth
+    with st.sidebar:
         if "user" not in st.session_state:
             login_ui(conn)
         else:
             logout_ui()
 
-        st.sidebar.divider()
+    st.sidebar.divider()
 
-        # Navigation (RBAC)
-        nav_all = ["Missions", "Temps / CRA", "Capacités", "Alertes", "Synthèse"]
+    # Navigation (RBAC)
+    nav_all = ["Missions", "Temps / CRA", "Capacités", "Alertes", "Synthèse"]
 
-        # Simulation Board/Admin uniquement
-        if "user" in st.session_state and role() in ("BOARD", "ADMIN"):
-            nav_all.append("Simulation (Board)")
+    # Simulation Board/Admin uniquement
+    if "user" in st.session_state and role() in ("BOARD", "ADMIN"):
+        nav_all.append("Simulation (Board)")
 
 
-        if "user" in st.session_state and is_admin():
-            nav_all.append("Admin")
+    if "user" in st.session_state and is_admin():
+        nav_all.append("Admin")
 
 
-        choice = st.sidebar.radio("Navigation", nav_all)
+    choice = st.sidebar.radio("Navigation", nav_all)
 
-        require_login()
+    require_login()
 
-        if choice == "Missions":
-            section_missions(conn)
-        elif choice == "Temps / CRA":
-            section_cra(conn)
-        elif choice == "Capacités":
-            section_capacites(conn)
-        elif choice == "Alertes":
-            section_alertes(conn)
-        elif choice == "Synthèse":
-            section_synthese(conn)
-        elif choice == "Simulation (Board)":
-            section_simulation_board(conn)
-        elif choice == "Admin":
-            section_admin(conn, settings)
-        else:
-            st.info("Choisissez une section.")
+    if choice == "Missions":
+        section_missions(conn)
+    elif choice == "Temps / CRA":
+        section_cra(conn)
+    elif choice == "Capacités":
+        section_capacites(conn)
+    elif choice == "Alertes":
+        section_alertes(conn)
+    elif choice == "Synthèse":
+        section_synthese(conn)
+    elif choice == "Simulation (Board)":
+        section_simulation_board(conn)
+    elif choice == "Admin":
+        section_admin(conn, settings)
+    else:
+        st.info("Choisissez une section.")
 
 
 if __name__ == "__main__":
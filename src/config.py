@@ -1,5 +1,6 @@
 from __future__ import annotations
 from dataclasses import dataclass
+from functools import lru_cache
 import os
 from pathlib import Path
 import yaml
@@ -17,7 +18,9 @@ class Settings:
     demo_admin_username: str
     demo_admin_password: str
 
+@lru_cache(maxsize=1)
 def load_settings() -> Settings:
+    # Lu une fois par process (.env + YAML) ; invalidate_settings() pour relire
     load_dotenv(override=False)
 
     env = os.getenv("APP_ENV", "local")
@@ -50,3 +53,6 @@ def load_settings() -> Settings:
         demo_admin_username=demo_admin_username,
         demo_admin_password=demo_admin_password,
     )
+
+def invalidate_settings() -> None:
+    load_settings.cache_clear()
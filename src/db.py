@@ -1,19 +1,117 @@
 from __future__ import annotations
+import itertools
 import sqlite3
 from contextlib import contextmanager
+from itertools import islice
+from typing import Iterable, Sequence
 from src.config import load_settings
 
-@contextmanager
-def get_conn():
-    settings = load_settings()
-    conn = sqlite3.connect(settings.db_path, check_same_thread=False)
+# Charge majoritairement en lecture : WAL (lecteurs non bloqués), fsync allégé,
+# pages mappées en mémoire (256 Mo), cache de pages 64 Mo, tables temporaires en RAM.
+PRAGMAS = (
+    "journal_mode = WAL",
+    "synchronous = NORMAL",
+    "mmap_size = 268435456",
+    "cache_size = -65536",
+    "temp_store = MEMORY",
+)
+
+def _unorm(s):
+    # LOWER() de SQLite ne replie que l'ASCII : "État" resterait "État"
+    return " ".join(s.split()).lower() if isinstance(s, str) else s
+
+_conn_seq = itertools.count()
+_sp_seq = itertools.count()
+
+class Connection(sqlite3.Connection):
+    # Jeton unique par connexion : clé de cache stable, là où id() peut être
+    # réattribué à une nouvelle connexion une fois l'ancienne libérée.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token = next(_conn_seq)
+
+def connect(db_path: str) -> Connection:
+    conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256, factory=Connection)
     conn.row_factory = sqlite3.Row
+    conn.create_function("unorm", 1, _unorm, deterministic=True)
     conn.execute("PRAGMA foreign_keys = ON;")
-    try:
+    for p in PRAGMAS:
+        conn.execute(f"PRAGMA {p};")
+    return conn
+
+def fetch_tuples(conn: sqlite3.Connection, sql: str, params=()) -> tuple[list[str], list[tuple]]:
+    # Curseur sans row_factory : lignes en tuples bruts (pas d'objet Row par ligne)
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    return [d[0] for d in cur.description], cur.fetchall()
+
+def bulk_insert(conn: sqlite3.Connection, table: str, cols: Sequence[str], rows: Iterable[Sequence],
+                verb: str = "INSERT") -> None:
+    """INSERT multi-lignes (VALUES (...), (...), ...) par lots : une instruction pour ~999/len(cols) lignes.
+
+    `rows` est consommé en flux ; les lots pleins partagent la même requête (cache de statements).
+    """
+    n = len(cols)
+    size = 999 // n  # SQLITE_MAX_VARIABLE_NUMBER historique
+    head = f"{verb} INTO {table}({', '.join(cols)}) VALUES "
+    ph = "(" + ", ".join("?" * n) + ")"
+    it = iter(rows)
+    while batch := list(islice(it, size)):
+        conn.execute(head + ", ".join([ph] * len(batch)), [v for r in batch for v in r])
+
+def get_conn(db_path: str | None = None) -> sqlite3.Connection:
+    """Nouvelle connexion configurée, à garder par appelant (une par session Streamlit).
+
+    Jamais partagée entre sessions : l'état transactionnel d'une connexion sqlite3
+    est unique, un commit / rollback d'une session validerait ou annulerait l'autre.
+    """
+    return connect(db_path or load_settings().db_path)
+
+@contextmanager
+def tx(conn: sqlite3.Connection):
+    """Transaction d'écriture : BEGIN IMMEDIATE, COMMIT en sortie, ROLLBACK sur exception.
+
+    Transaction déjà ouverte sur la connexion : SAVEPOINT. Un échec annule la part
+    du bloc (ROLLBACK TO) et remonte ; le COMMIT reste à qui a ouvert la transaction.
+    """
+    if conn.in_transaction:
+        sp = f"tx_{next(_sp_seq)}"
+        conn.execute(f"SAVEPOINT {sp}")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute(f"ROLLBACK TO {sp}")
+            conn.execute(f"RELEASE {sp}")
+            raise
+        conn.execute(f"RELEASE {sp}")
+        return
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
         yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
+
+@contextmanager
+def bulk_load(conn: sqlite3.Connection):
+    """Chargement en masse (seed, import) sur une connexion dédiée au même fichier,
+    fermée en sortie : pas de fsync, cache de pages élargi, FK désactivées (le
+    chargeur vérifie l'intégrité par PRAGMA foreign_key_check avant commit).
+
+    S'utilise `with bulk_load(conn) as conn, tx(conn):`. Les réglages ne touchent
+    que cette connexion : celle de l'appelant (et des autres sessions) garde ses FK
+    et son fsync. synchronous = OFF en WAL ne peut pas corrompre la base : au pire,
+    un crash OS perd le dernier chargement, qu'il suffit de relancer.
+    Transaction déjà ouverte (une seconde connexion attendrait son verrou) ou base
+    en mémoire : la connexion de l'appelant est rendue telle quelle.
+    """
+    path = None if conn.in_transaction else conn.execute("PRAGMA database_list").fetchone()[2]
+    if not path:
+        yield conn
+        return
+    bulk = connect(path)
+    try:
+        bulk.execute("PRAGMA synchronous = OFF")
+        bulk.execute("PRAGMA cache_size = -262144")
+        bulk.execute("PRAGMA foreign_keys = OFF")
+        yield bulk
     finally:
-        conn.close()
+        bulk.close()
@@ -1,10 +1,31 @@
 from __future__ import annotations
+import hashlib
+import hmac
+import secrets
 import bcrypt
 
+# Vérifications réussies mémorisées (process uniquement) : un rerun Streamlit ne repaie
+# pas ~250 ms de bcrypt. Clé = HMAC à clé aléatoire par process, jamais le mot de passe.
+# Les échecs ne sont pas mémorisés : chaque mauvais essai coûte un bcrypt complet.
+_CACHE_KEY = secrets.token_bytes(32)
+_VERIFIED: set[tuple[bytes, bytes]] = set()
+_VERIFIED_MAX = 128
+
+def _digest(s: str) -> bytes:
+    return hmac.new(_CACHE_KEY, s.encode("utf-8"), hashlib.sha256).digest()
+
 def hash_password(password_clear: str, rounds: int = 12) -> str:
     salt = bcrypt.gensalt(rounds=rounds)
     hashed = bcrypt.hashpw(password_clear.encode("utf-8"), salt)
     return hashed.decode("utf-8")
 
 def verify_password(password_clear: str, password_hash: str) -> bool:
-    return bcrypt.checkpw(password_clear.encode("utf-8"), password_hash.encode("utf-8"))
+    key = (_digest(password_clear), _digest(password_hash))
+    if key in _VERIFIED:
+        return True
+    ok = bcrypt.checkpw(password_clear.encode("utf-8"), password_hash.encode("utf-8"))
+    if ok:
+        if len(_VERIFIED) >= _VERIFIED_MAX:
+            _VERIFIED.clear()
+        _VERIFIED.add(key)
+    return ok
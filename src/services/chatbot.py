@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import json
 import re
 import sqlite3
 from dataclasses import dataclass
@@ -7,6 +8,8 @@ from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
 
+from src.db import fetch_tuples
+
 
 @dataclass(frozen=True)
 class ChatContext:
@@ -17,14 +20,157 @@ class ChatContext:
     visible_user_ids: List[int]  # pour les questions de charge
 
 
+# Motifs compilés une fois au chargement du module
+_WS_RE = re.compile(r"\s+")
+# accepte M-2026-002, m2026-002, M 2026 002...
+_MISSION_CODE_RE = re.compile(r"\b(m)\s*[- ]?\s*(\d{4})\s*[- ]?\s*(\d{3})\b", re.IGNORECASE)
+
+# Mots-clés par intention, dans l'ordre de priorité : une alternance par intention
+# remplace les scans `any(k in q ...)` successifs.
+_INTENT_KEYWORDS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("help", ("aide", "help", "que peux-tu", "exemple")),
+    ("projects_risk", ("à risque", "risque", "dérive", "overrun", "near limit", "alerte")),
+    ("who_busy", ("plus chargé", "surcharg", "qui est chargé", "busy", "charge")),
+    ("time_split", ("répartition", "billable", "internal", "non billable", "catégorie")),
+    ("finance_summary", ("marge", "margin", "coût", "cout", "ca", "chiffre", "€", "eur", "finance")),
+    ("status_global", ("où en est", "où en est-on", "statut", "global", "cette semaine", "this week")),
+)
+_INTENT_PATTERNS = [
+    (name, re.compile("|".join(map(re.escape, kws)))) for name, kws in _INTENT_KEYWORDS
+]
+
+_WORD_RE = re.compile(r"\w+")
+
+SQL_MISSION_BY_CODE = """
+SELECT id, code, name
+FROM missions
+WHERE id IN (SELECT value FROM json_each(?1))
+  AND UPPER(code) = UPPER(?2)
+LIMIT 1
+"""
+
+# Score sur les mots du nom découpés par CTE récursive (unorm, cf. src.db), parmi les
+# missions visibles : SQL_MISSION_SCORE_FTS restreint d'abord aux candidats missions_fts
+# dont un mot commence par un mot de la question (requête préfixe "mot"*).
+_SQL_MISSION_SCORE = """
+WITH RECURSIVE
+m(id, code, name, n, c) AS (
+  SELECT id, code, name, unorm(name), unorm(code)
+  FROM missions
+  WHERE id IN (SELECT value FROM json_each(?1)){fts}
+),
+w(id, word, rest) AS (
+  SELECT id, '', n || ' ' FROM m
+  UNION ALL
+  SELECT id, substr(rest, 1, instr(rest, ' ') - 1), substr(rest, instr(rest, ' ') + 1)
+  FROM w WHERE rest <> ''
+),
+b(id, bonus) AS (
+  SELECT id, 2 * COUNT(*)
+  FROM w
+  WHERE length(word) >= 4 AND word <> 'mission' AND instr(?2, word) > 0
+  GROUP BY id
+)
+SELECT m.id, m.code, m.name,
+       (CASE WHEN m.n <> '' AND instr(?2, m.n) > 0 THEN 10 ELSE 0 END)
+     + (CASE WHEN m.c <> '' AND instr(?2, m.c) > 0 THEN 10 ELSE 0 END)
+     + COALESCE(b.bonus, 0) AS score
+FROM m LEFT JOIN b ON b.id = m.id
+ORDER BY score DESC, m.id
+LIMIT 1
+"""
+SQL_MISSION_SCORE = _SQL_MISSION_SCORE.format(fts="")
+SQL_MISSION_SCORE_FTS = _SQL_MISSION_SCORE.format(
+    fts="\n    AND id IN (SELECT rowid FROM missions_fts WHERE missions_fts MATCH ?3)"
+)
+
+
+# Requêtes des intentions : texte fixe, liste d'ids passée en JSON (json_each)
+SQL_STATUS_TOTALS = """
+SELECT
+  COUNT(*) AS missions_count,
+  SUM(consumed_hours) AS consumed_hours,
+  SUM(sold_hours) AS sold_hours
+FROM kpi_mission_hours
+WHERE mission_id IN (SELECT value FROM json_each(?))
+"""
+
+SQL_STATUS_TOP_VARIANCE = """
+SELECT mission_code, mission_name, client_name, sold_hours, consumed_hours, variance_hours
+FROM kpi_mission_variance
+WHERE mission_id IN (SELECT value FROM json_each(?))
+ORDER BY variance_hours DESC
+LIMIT 5
+"""
+
+SQL_PROJECTS_RISK = """
+SELECT mission_code, mission_name, client_name, sold_hours, consumed_hours, variance_hours, risk_level
+FROM kpi_alert_missions_risk
+WHERE mission_id IN (SELECT value FROM json_each(?))
+ORDER BY
+  CASE risk_level
+    WHEN 'overrun' THEN 3
+    WHEN 'near_limit' THEN 2
+    WHEN 'no_sold_load' THEN 1
+    ELSE 0
+  END DESC,
+  variance_hours DESC
+"""
+
+SQL_WHO_BUSY = """
+SELECT user_name, SUM(logged_hours) AS logged_hours
+FROM kpi_user_load_daily
+WHERE user_id IN (SELECT value FROM json_each(?))
+GROUP BY user_name
+ORDER BY logged_hours DESC
+"""
+
+SQL_TIME_SPLIT = """
+SELECT category, SUM(hours) AS hours,
+       ROUND(SUM(hours) * 100.0 / SUM(SUM(hours)) OVER (), 1) AS pct
+FROM time_entries
+WHERE user_id IN (SELECT value FROM json_each(?))
+GROUP BY category
+ORDER BY hours DESC
+"""
+
+SQL_FINANCE_TOTALS = """
+SELECT
+  SUM(sold_amount_eur) AS sold_amount_eur,
+  SUM(cost_eur) AS cost_eur,
+  SUM(margin_eur) AS margin_eur
+FROM kpi_finance_mission
+WHERE mission_id IN (SELECT value FROM json_each(?))
+"""
+
+SQL_FINANCE_TOP = """
+SELECT client_name, mission_code, mission_name, sold_amount_eur, cost_eur, margin_eur
+FROM kpi_finance_mission
+WHERE mission_id IN (SELECT value FROM json_each(?))
+ORDER BY margin_eur ASC
+LIMIT 10
+"""
+
+
 def _df(conn: sqlite3.Connection, sql: str, params: Tuple[Any, ...] = ()) -> pd.DataFrame:
-    return pd.read_sql_query(sql, conn, params=params)
+    # Résultats de quelques lignes : tuples bruts + from_records, sans read_sql_query
+    cols, rows = fetch_tuples(conn, sql, params)
+    return pd.DataFrame.from_records(rows, columns=cols)
+
+
+def _row(conn: sqlite3.Connection, sql: str, params: Tuple[Any, ...] = ()) -> Dict[str, Any]:
+    # Agrégats à une ligne : pas de DataFrame
+    row = conn.execute(sql, params).fetchone()
+    return dict(row) if row is not None else {}
+
+
+def _ids_json(ids: List[int]) -> str:
+    # Paramètre des filtres IN (SELECT value FROM json_each(?))
+    return json.dumps([int(i) for i in ids])
 
 
 def _sanitize_question(q: str) -> str:
-    q = (q or "").strip().lower()
-    q = re.sub(r"\s+", " ", q)
-    return q
+    return _WS_RE.sub(" ", (q or "").strip().lower())
 
 
 def _intent(q: str) -> str:
@@ -40,33 +186,17 @@ def _intent(q: str) -> str:
     if not q:
         return "help"
 
-    if any(k in q for k in ["aide", "help", "que peux-tu", "exemple"]):
-        return "help"
-
-    if any(k in q for k in ["à risque", "risque", "dérive", "overrun", "near limit", "alerte"]):
-        return "projects_risk"
-
-    if any(k in q for k in ["plus chargé", "surcharg", "qui est chargé", "busy", "charge"]):
-        return "who_busy"
-
-    if any(k in q for k in ["répartition", "billable", "internal", "non billable", "catégorie"]):
-        return "time_split"
-
-    if any(k in q for k in ["marge", "margin", "coût", "cout", "ca", "chiffre", "€", "eur", "finance"]):
-        return "finance_summary"
-
-    if any(k in q for k in ["où en est", "où en est-on", "statut", "global", "cette semaine", "this week"]):
-        return "status_global"
+    for name, pat in _INTENT_PATTERNS:
+        if pat.search(q):
+            return name
 
     return "status_global"
 
 def _normalize(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "")).strip().lower()
+    return _WS_RE.sub(" ", (s or "")).strip().lower()
 
 def _extract_mission_code(text: str) -> Optional[str]:
-    # accepte M-2026-002, m2026-002, M 2026 002...
-    t = text or ""
-    m = re.search(r"\b(m)\s*[- ]?\s*(\d{4})\s*[- ]?\s*(\d{3})\b", t, flags=re.IGNORECASE)
+    m = _MISSION_CODE_RE.search(text or "")
     if not m:
         return None
     return f"M-{m.group(2)}-{m.group(3)}"
@@ -79,56 +209,35 @@ def _find_mission_by_name_or_code(conn, mission_ids: list[int], text: str) -> Op
         return None
 
     code = _extract_mission_code(text)
-    params = tuple(mission_ids)
+    ids = _ids_json(mission_ids)
 
     # 1) match exact par code
     if code:
-        q = f"""
-        SELECT id, code, name
-        FROM missions
-        WHERE id IN ({",".join(["?"]*len(mission_ids))})
-          AND UPPER(code) = UPPER(?)
-        LIMIT 1
-        """
-        row = conn.execute(q, params + (code,)).fetchone()
+        row = conn.execute(SQL_MISSION_BY_CODE, (ids, code)).fetchone()
         if row:
             return dict(row)
 
-    # 2) match par nom (contient)
+    # 2) match par nom (préfixes via missions_fts, sinon contient)
     # on ne fait pas du vrai fuzzy pour rester simple et déterministe
     t = _normalize(text)
     if len(t) < 3:
         return None
 
-    q2 = f"""
-    SELECT id, code, name
-    FROM missions
-    WHERE id IN ({",".join(["?"]*len(mission_ids))})
-    """
-    rows = conn.execute(q2, params).fetchall()
-    if not rows:
+    # score calculé par SQLite : nom / code contenus dans la question (+10 chacun),
+    # +2 par mot du nom (>= 4 lettres, hors "mission") présent dans la question.
+    # À score égal, la plus petite id l'emporte (ordre de l'ancien parcours Python).
+    words = _WORD_RE.findall(t)
+    if not words:
         return None
-
-    # score simple: nom présent dans la question ou mots communs
-    best = None
-    best_score = 0
-    for r in rows:
-        name = _normalize(r["name"])
-        code2 = _normalize(r["code"])
-        score = 0
-        if name and name in t:
-            score += 10
-        if code2 and code2 in t:
-            score += 10
-        # score par mots (évite "Mission" trop générique)
-        for w in [w for w in name.split(" ") if len(w) >= 4 and w not in ("mission",)]:
-            if w in t:
-                score += 2
-        if score > best_score:
-            best_score = score
-            best = dict(r)
-
-    return best if best_score >= 4 else None
+    match = " OR ".join(f'"{w}"*' for w in dict.fromkeys(words))
+    row = conn.execute(SQL_MISSION_SCORE_FTS, (ids, t, match)).fetchone()
+    if row is None or row["score"] < 4:
+        # Mot du nom contenu dans un mot de la question ("plateformes" -> "Plateforme") :
+        # hors de portée des préfixes FTS, score sur toutes les missions visibles
+        row = conn.execute(SQL_MISSION_SCORE, (ids, t)).fetchone()
+    if row is None or row["score"] < 4:
+        return None
+    return {"id": row["id"], "code": row["code"], "name": row["name"]}
 
 def _answer_mission_status(conn, ctx, mission: dict) -> dict:
     mid = int(mission["id"])
@@ -150,7 +259,8 @@ def _answer_mission_status(conn, ctx, mission: dict) -> dict:
     r = dict(row)
 
     # Répartition par catégories (billable/non_billable/internal)
-    dist = conn.execute(
+    dist_df = _df(
+        conn,
         """
         SELECT category, COALESCE(SUM(hours),0) AS hours
         FROM time_entries
@@ -158,8 +268,7 @@ def _answer_mission_status(conn, ctx, mission: dict) -> dict:
         GROUP BY category
         """,
         (mid,),
-    ).fetchall()
-    dist_df = pd.DataFrame([dict(x) for x in dist]) if dist else pd.DataFrame(columns=["category","hours"])
+    )
 
     text = (
         f"**Focus mission : {r['mission_code']} — {r['mission_name']} ({r['client_name']})**\n\n"
@@ -270,14 +379,9 @@ def answer_question(conn: sqlite3.Connection, ctx: ChatContext, question: str) -
             "tables": [],
         }
 
-    # Helpers filtres
-    def in_clause(ids: List[int]) -> Tuple[str, Tuple[Any, ...]]:
-        if not ids:
-            return "(NULL)", tuple()
-        return "(" + ",".join(["?"] * len(ids)) + ")", tuple(ids)
-
-    mids_sql, mids_params = in_clause(ctx.mission_ids)
-    uids_sql, uids_params = in_clause(ctx.visible_user_ids)
+    # Filtres IN : une liste JSON par périmètre
+    mids_params = (_ids_json(ctx.mission_ids),)
+    uids_params = (_ids_json(ctx.visible_user_ids),)
 
     # --- HELP
     if intent == "help":
@@ -295,19 +399,7 @@ def answer_question(conn: sqlite3.Connection, ctx: ChatContext, question: str) -
 
     # --- STATUS GLOBAL (simple, sans dépendre d’une période dans ce livrable)
     if intent == "status_global":
-        df = _df(
-            conn,
-            f"""
-            SELECT
-              COUNT(*) AS missions_count,
-              SUM(consumed_hours) AS consumed_hours,
-              SUM(sold_hours) AS sold_hours
-            FROM kpi_mission_hours
-            WHERE mission_id IN {mids_sql}
-            """,
-            mids_params,
-        )
-        row = df.iloc[0].to_dict()
+        row = _row(conn, SQL_STATUS_TOTALS, mids_params)
         missions_count = int(row.get("missions_count") or 0)
         consumed_hours = float(row.get("consumed_hours") or 0)
         sold_hours = float(row.get("sold_hours") or 0)
@@ -321,17 +413,7 @@ def answer_question(conn: sqlite3.Connection, ctx: ChatContext, question: str) -
         )
 
         # Mini top 5 dérives (opérationnel)
-        df2 = _df(
-            conn,
-            f"""
-            SELECT mission_code, mission_name, client_name, sold_hours, consumed_hours, variance_hours
-            FROM kpi_mission_variance
-            WHERE mission_id IN {mids_sql}
-            ORDER BY variance_hours DESC
-            LIMIT 5
-            """,
-            mids_params,
-        )
+        df2 = _df(conn, SQL_STATUS_TOP_VARIANCE, mids_params)
         tables = []
         if not df2.empty:
             tables.append({"title": "Top dérives (heures)", "df": df2})
@@ -340,23 +422,7 @@ def answer_question(conn: sqlite3.Connection, ctx: ChatContext, question: str) -
 
     # --- PROJECTS RISK
     if intent == "projects_risk":
-        df = _df(
-            conn,
-            f"""
-            SELECT mission_code, mission_name, client_name, sold_hours, consumed_hours, variance_hours, risk_level
-            FROM kpi_alert_missions_risk
-            WHERE mission_id IN {mids_sql}
-            ORDER BY
-              CASE risk_level
-                WHEN 'overrun' THEN 3
-                WHEN 'near_limit' THEN 2
-                WHEN 'no_sold_load' THEN 1
-                ELSE 0
-              END DESC,
-              variance_hours DESC
-            """,
-            mids_params,
-        )
+        df = _df(conn, SQL_PROJECTS_RISK, mids_params)
         if df.empty:
             return {"text": "Aucun projet à risque détecté sur ton périmètre.", "tables": []}
 
@@ -368,17 +434,7 @@ def answer_question(conn: sqlite3.Connection, ctx: ChatContext, question: str) -
         if not ctx.visible_user_ids:
             return {"text": "Je n’ai aucun utilisateur visible pour calculer la charge.", "tables": []}
 
-        df = _df(
-            conn,
-            f"""
-            SELECT user_name, SUM(logged_hours) AS logged_hours
-            FROM kpi_user_load_daily
-            WHERE user_id IN {uids_sql}
-            GROUP BY user_name
-            ORDER BY logged_hours DESC
-            """,
-            uids_params,
-        )
+        df = _df(conn, SQL_WHO_BUSY, uids_params)
         if df.empty:
             return {"text": "Aucune saisie de temps trouvée pour calculer la charge.", "tables": []}
 
@@ -389,25 +445,12 @@ def answer_question(conn: sqlite3.Connection, ctx: ChatContext, question: str) -
     # --- TIME SPLIT (répartition catégories)
     if intent == "time_split":
         # NB: consultant ne voit que lui-même via visible_user_ids (déjà filtré)
-        df = _df(
-            conn,
-            f"""
-            SELECT category, SUM(hours) AS hours
-            FROM time_entries
-            WHERE user_id IN {uids_sql}
-            GROUP BY category
-            ORDER BY hours DESC
-            """,
-            uids_params,
-        )
+        df = _df(conn, SQL_TIME_SPLIT, uids_params)
         if df.empty:
             return {"text": "Aucune donnée de temps pour calculer la répartition.", "tables": []}
 
-        total = float(df["hours"].sum())
         txt = "Répartition du temps (heures) :"
-        df2 = df.copy()
-        df2["pct"] = (df2["hours"] / total * 100.0).round(1)
-        return {"text": txt, "tables": [{"title": "Répartition par catégorie", "df": df2}]}
+        return {"text": txt, "tables": [{"title": "Répartition par catégorie", "df": df}]}
 
     # --- FINANCE SUMMARY (Board/Admin only)
     if intent == "finance_summary":
@@ -417,19 +460,7 @@ def answer_question(conn: sqlite3.Connection, ctx: ChatContext, question: str) -
                 "tables": [],
             }
 
-        df = _df(
-            conn,
-            f"""
-            SELECT
-              SUM(sold_amount_eur) AS sold_amount_eur,
-              SUM(cost_eur) AS cost_eur,
-              SUM(margin_eur) AS margin_eur
-            FROM kpi_finance_mission
-            WHERE mission_id IN {mids_sql}
-            """,
-            mids_params,
-        )
-        row = df.iloc[0].to_dict()
+        row = _row(conn, SQL_FINANCE_TOTALS, mids_params)
         sold = float(row.get("sold_amount_eur") or 0)
         cost = float(row.get("cost_eur") or 0)
         margin = float(row.get("margin_eur") or 0)
@@ -441,17 +472,7 @@ def answer_question(conn: sqlite3.Connection, ctx: ChatContext, question: str) -
             f"- Marge : {margin:,.0f} €"
         ).replace(",", " ")
 
-        df2 = _df(
-            conn,
-            f"""
-            SELECT client_name, mission_code, mission_name, sold_amount_eur, cost_eur, margin_eur
-            FROM kpi_finance_mission
-            WHERE mission_id IN {mids_sql}
-            ORDER BY margin_eur ASC
-            LIMIT 10
-            """,
-            mids_params,
-        )
+        df2 = _df(conn, SQL_FINANCE_TOP, mids_params)
         return {"text": txt, "tables": [{"title": "Top 10 missions (marge la plus faible)", "df": df2}]}
 
     # Fallback
@@ -1,6 +1,7 @@
 from __future__ import annotations
 import sqlite3
 from src.config import Settings
+from src.db import PRAGMAS, tx
 
 DDL = """
 PRAGMA foreign_keys = ON;
@@ -45,7 +46,7 @@ CREATE TABLE IF NOT EXISTS mission_leads (
   PRIMARY KEY (mission_id, user_id),
   FOREIGN KEY (mission_id) REFERENCES missions(id) ON DELETE CASCADE,
   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-);
+) WITHOUT ROWID;
 
 CREATE TABLE IF NOT EXISTS mission_assignments (
   id              INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -58,6 +59,8 @@ CREATE TABLE IF NOT EXISTS mission_assignments (
   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+CREATE INDEX IF NOT EXISTS ix_mission_assignments_mission_user ON mission_assignments(mission_id, user_id);
+
 CREATE TABLE IF NOT EXISTS time_entries (
   id            INTEGER PRIMARY KEY AUTOINCREMENT,
   entry_date    TEXT NOT NULL,
@@ -74,9 +77,6 @@ CREATE TABLE IF NOT EXISTS time_entries (
 CREATE UNIQUE INDEX IF NOT EXISTS ux_time_entry_unique_day
 ON time_entries(entry_date, user_id, COALESCE(mission_id, -1), category);
 
-CREATE INDEX IF NOT EXISTS ix_time_entries_user_date ON time_entries(user_id, entry_date);
-CREATE INDEX IF NOT EXISTS ix_time_entries_mission_date ON time_entries(mission_id, entry_date);
-
 CREATE TABLE IF NOT EXISTS capacity_overrides (
   id           INTEGER PRIMARY KEY AUTOINCREMENT,
   user_id      INTEGER NOT NULL,
@@ -90,7 +90,7 @@ CREATE TABLE IF NOT EXISTS capacity_overrides (
 CREATE TABLE IF NOT EXISTS app_settings (
   key   TEXT PRIMARY KEY,
   value TEXT NOT NULL
-);
+) WITHOUT ROWID;
 -- =========================
 -- Simulation Board (devis + suivi)
 -- =========================
@@ -197,28 +197,54 @@ CREATE INDEX IF NOT EXISTS ix_chat_audit_user ON chat_audit(user_id);
 CREATE INDEX IF NOT EXISTS ix_chat_audit_intent ON chat_audit(intent);
 CREATE INDEX IF NOT EXISTS ix_chat_audit_mission ON chat_audit(mission_id);
 
--- Views KPI
-CREATE VIEW IF NOT EXISTS kpi_mission_hours AS
-SELECT
-  m.id              AS mission_id,
-  m.code            AS mission_code,
-  m.name            AS mission_name,
-  c.name            AS client_name,
-  m.status          AS status,
-  m.start_date      AS start_date,
-  m.end_date        AS end_date,
-  m.sold_days       AS sold_days,
-  ROUND(m.sold_days * 8.0, 2) AS sold_hours,
-  COALESCE(SUM(te.hours), 0)  AS consumed_hours,
-  ROUND((COALESCE(SUM(te.hours), 0) / NULLIF(m.sold_days * 8.0, 0)) * 100.0, 1) AS consumed_pct
-FROM missions m
-JOIN clients c ON c.id = m.client_id
-LEFT JOIN time_entries te
-  ON te.mission_id = m.id
- AND te.category IN ('billable','non_billable_client')
-WHERE m.is_active = 1
-GROUP BY m.id;
+-- Recherche plein texte des missions (chatbot) : index externe sur missions,
+-- tenu à jour par triggers
+CREATE VIRTUAL TABLE IF NOT EXISTS missions_fts USING fts5(
+  name, code,
+  content='missions', content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS missions_fts_ai AFTER INSERT ON missions BEGIN
+  INSERT INTO missions_fts(rowid, name, code) VALUES (new.id, new.name, new.code);
+END;
+
+CREATE TRIGGER IF NOT EXISTS missions_fts_ad AFTER DELETE ON missions BEGIN
+  INSERT INTO missions_fts(missions_fts, rowid, name, code) VALUES ('delete', old.id, old.name, old.code);
+END;
+
+CREATE TRIGGER IF NOT EXISTS missions_fts_au AFTER UPDATE OF name, code ON missions BEGIN
+  INSERT INTO missions_fts(missions_fts, rowid, name, code) VALUES ('delete', old.id, old.name, old.code);
+  INSERT INTO missions_fts(rowid, name, code) VALUES (new.id, new.name, new.code);
+END;
+
+-- KPI matérialisés : agrégats de time_entries tenus à jour par les triggers
+-- KPI_TRIGGERS, recalculés en bloc par refresh_kpis() (démarrage, seed). Les vues
+-- kpi_mission_hours / kpi_finance_mission / kpi_user_load_daily /
+-- kpi_user_logged_daily / kpi_time_by_category_daily lisent ces tables au lieu
+-- de ré-agréger time_entries.
+CREATE TABLE IF NOT EXISTS kpi_mission_consumed_t (
+  mission_id     INTEGER PRIMARY KEY,
+  consumed_hours INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS kpi_user_load_daily_t (
+  day          TEXT NOT NULL,
+  user_id      INTEGER NOT NULL,
+  logged_hours INTEGER NOT NULL,
+  PRIMARY KEY (day, user_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS ix_kpi_user_load_daily_t_user ON kpi_user_load_daily_t(user_id, day);
 
+CREATE TABLE IF NOT EXISTS kpi_time_by_category_daily_t (
+  day      TEXT NOT NULL,
+  category TEXT NOT NULL,
+  hours    INTEGER NOT NULL,
+  PRIMARY KEY (day, category)
+) WITHOUT ROWID;
+
+-- Views KPI
 CREATE VIEW IF NOT EXISTS kpi_mission_variance AS
 SELECT
   mission_id,
@@ -248,118 +274,61 @@ SELECT
 FROM kpi_mission_variance
 WHERE (sold_hours = 0) OR (consumed_hours >= sold_hours * 0.9);
 
-CREATE VIEW IF NOT EXISTS kpi_user_load_daily AS
-SELECT
-  te.entry_date AS day,
-  u.id          AS user_id,
-  u.full_name   AS user_name,
-  SUM(te.hours) AS logged_hours
-FROM time_entries te
-JOIN users u ON u.id = te.user_id
-WHERE u.is_active = 1
-GROUP BY te.entry_date, u.id;
-
-CREATE VIEW IF NOT EXISTS kpi_time_by_category_daily AS
-SELECT
-  entry_date AS day,
-  category,
-  SUM(hours) AS hours
-FROM time_entries
-GROUP BY entry_date, category;
-
-CREATE VIEW IF NOT EXISTS kpi_finance_mission AS
-SELECT
-  m.id AS mission_id,
-  m.code AS mission_code,
-  m.name AS mission_name,
-  c.name AS client_name,
-  m.sold_amount_eur AS sold_amount_eur,
-  m.daily_cost_eur  AS daily_cost_eur,
-  COALESCE(SUM(te.hours), 0) AS consumed_hours,
-  ROUND((COALESCE(SUM(te.hours), 0) / 8.0) * m.daily_cost_eur, 2) AS cost_eur,
-  ROUND(m.sold_amount_eur - ((COALESCE(SUM(te.hours), 0) / 8.0) * m.daily_cost_eur), 2) AS margin_eur
-FROM missions m
-JOIN clients c ON c.id = m.client_id
-LEFT JOIN time_entries te
-  ON te.mission_id = m.id
- AND te.category IN ('billable','non_billable_client')
-WHERE m.is_active = 1
-GROUP BY m.id;
-
--- =========================
--- KPI Simulation (Board)
--- =========================
+"""
 
-CREATE VIEW IF NOT EXISTS kpi_simulation_summary AS
-WITH
-internal AS (
-  SELECT
-    simulation_id,
-    SUM(planned_days * hours_per_day) AS planned_hours,
-    SUM(planned_days * hours_per_day * billable_ratio) AS billable_hours,
-    SUM(planned_days * hours_per_day * std_rate_per_hour * billable_ratio) AS revenue_std,
-    SUM(planned_days * hours_per_day * std_cost_per_hour) AS cost_internal
-  FROM simulation_internal_resources
-  GROUP BY simulation_id
-),
-external AS (
-  SELECT
-    simulation_id,
-    SUM(planned_days * sell_rate_per_day) AS revenue_external,
-    SUM(planned_days * buy_rate_per_day)  AS cost_external
-  FROM simulation_external_resources
-  GROUP BY simulation_id
-),
-costs AS (
-  SELECT
-    simulation_id,
-    SUM(cost_amount) AS cost_other,
-    SUM(refactured_amount) AS revenue_other
-  FROM simulation_costs
-  GROUP BY simulation_id
+# Index secondaires de time_entries, hors DDL : le seed les supprime avant
+# l'insertion en masse et les recrée ensuite (un tri au lieu de N mises à jour
+# de B-tree). ux_time_entry_unique_day reste en place : INSERT OR IGNORE en dépend.
+DDL_INDEXES = (
+    ("ix_time_entries_user_date", "time_entries(user_id, entry_date)"),
+    ("ix_time_entries_mission_date", "time_entries(mission_id, entry_date)"),
+    ("ix_time_entries_user_mission", "time_entries(user_id, mission_id)"),
+    # Couvrants pour les agrégats par catégorie (KPI mission, chatbot) : lecture d'index seule.
+    ("ix_te_mission_cat_date", "time_entries(mission_id, category, entry_date, hours)"),
+    ("ix_te_uid_cat", "time_entries(user_id, category, hours)"),
 )
-SELECT
-  s.id AS simulation_id,
-  s.mission_id,
-  s.client_name,
-  s.project_name,
-  s.sector,
-  s.start_date,
-  s.end_date,
-  s.status,
-  s.created_at,
-
-  COALESCE(i.planned_hours, 0) AS planned_hours,
-  COALESCE(i.billable_hours, 0) AS billable_hours,
-
-  -- CA = production std interne (billable) + vente externe + refacturations
-  (COALESCE(i.revenue_std, 0) + COALESCE(e.revenue_external, 0) + COALESCE(c.revenue_other, 0)) AS revenue_total,
-
-  -- Coûts = interne + externe + autres
-  (COALESCE(i.cost_internal, 0) + COALESCE(e.cost_external, 0) + COALESCE(c.cost_other, 0)) AS cost_total,
-
-  -- Marge
-  ((COALESCE(i.revenue_std, 0) + COALESCE(e.revenue_external, 0) + COALESCE(c.revenue_other, 0))
-   - (COALESCE(i.cost_internal, 0) + COALESCE(e.cost_external, 0) + COALESCE(c.cost_other, 0))) AS margin_total,
-
-  CASE
-    WHEN (COALESCE(i.revenue_std, 0) + COALESCE(e.revenue_external, 0) + COALESCE(c.revenue_other, 0)) = 0 THEN NULL
-    ELSE ROUND(
-      (
-        ((COALESCE(i.revenue_std, 0) + COALESCE(e.revenue_external, 0) + COALESCE(c.revenue_other, 0))
-         - (COALESCE(i.cost_internal, 0) + COALESCE(e.cost_external, 0) + COALESCE(c.cost_other, 0)))
-        /
-        (COALESCE(i.revenue_std, 0) + COALESCE(e.revenue_external, 0) + COALESCE(c.revenue_other, 0))
-      ) * 100.0
-    , 1)
-  END AS margin_pct
-
-FROM simulations s
-LEFT JOIN internal i ON i.simulation_id = s.id
-LEFT JOIN external e ON e.simulation_id = s.id
-LEFT JOIN costs c ON c.simulation_id = s.id;
 
+# Tables à clé primaire seule (ou quasi) : rangées directement dans le B-tree de
+# la PK, sans rowid ni index d'unicité séparé.
+WITHOUT_ROWID_TABLES = ("mission_leads", "app_settings")
+
+# Maintenance incrémentale des tables KPI : une écriture dans time_entries
+# ajoute / retire ses heures ; une ligne retombée à 0 est supprimée, refresh_kpis
+# n'en crée pas (HAVING SUM(hours) > 0) : les deux chemins donnent les mêmes tables.
+_KPI_ADD = """
+  INSERT INTO kpi_user_load_daily_t(day, user_id, logged_hours)
+  VALUES (new.entry_date, new.user_id, new.hours)
+  ON CONFLICT(day, user_id) DO UPDATE SET logged_hours = logged_hours + excluded.logged_hours;
+  INSERT INTO kpi_mission_consumed_t(mission_id, consumed_hours)
+  SELECT new.mission_id, new.hours
+  WHERE new.mission_id IS NOT NULL AND new.category IN ('billable','non_billable_client')
+  ON CONFLICT(mission_id) DO UPDATE SET consumed_hours = consumed_hours + excluded.consumed_hours;
+  INSERT INTO kpi_time_by_category_daily_t(day, category, hours)
+  VALUES (new.entry_date, new.category, new.hours)
+  ON CONFLICT(day, category) DO UPDATE SET hours = hours + excluded.hours;
+"""
+_KPI_SUB = """
+  UPDATE kpi_user_load_daily_t SET logged_hours = logged_hours - old.hours
+  WHERE day = old.entry_date AND user_id = old.user_id;
+  DELETE FROM kpi_user_load_daily_t
+  WHERE day = old.entry_date AND user_id = old.user_id AND logged_hours <= 0;
+  UPDATE kpi_mission_consumed_t SET consumed_hours = consumed_hours - old.hours
+  WHERE mission_id = old.mission_id AND old.category IN ('billable','non_billable_client');
+  DELETE FROM kpi_mission_consumed_t WHERE mission_id = old.mission_id AND consumed_hours <= 0;
+  UPDATE kpi_time_by_category_daily_t SET hours = hours - old.hours
+  WHERE day = old.entry_date AND category = old.category;
+  DELETE FROM kpi_time_by_category_daily_t
+  WHERE day = old.entry_date AND category = old.category AND hours <= 0;
 """
+KPI_TRIGGERS = (
+    ("time_entries_kpi_ai", "AFTER INSERT ON time_entries", _KPI_ADD),
+    ("time_entries_kpi_ad", "AFTER DELETE ON time_entries", _KPI_SUB),
+    (
+        "time_entries_kpi_au",
+        "AFTER UPDATE OF entry_date, user_id, mission_id, category, hours ON time_entries",
+        _KPI_SUB + _KPI_ADD,
+    ),
+)
 
 DEFAULT_SETTINGS = {
     "time.day_hours": "8",
@@ -368,15 +337,104 @@ DEFAULT_SETTINGS = {
 
 def ensure_schema(conn: sqlite3.Connection, settings: Settings) -> None:
     conn.executescript(DDL)
+    for t in WITHOUT_ROWID_TABLES:
+        _migrate_without_rowid(conn, t)
+    create_indexes(conn)
+    create_kpi_triggers(conn)
+    # Hors transaction (executescript a validé) : WAL est persisté dans le fichier,
+    # les autres réglages valent pour cette connexion, quelle que soit son origine.
+    for p in PRAGMAS:
+        conn.execute(f"PRAGMA {p};")
     for k, v in DEFAULT_SETTINGS.items():
         conn.execute(
             "INSERT OR IGNORE INTO app_settings(key, value) VALUES (?, ?)",
             (k, v),
         )
+    # Resynchronise l'index (bases créées avant missions_fts)
+    conn.execute("INSERT INTO missions_fts(missions_fts) VALUES ('rebuild')")
     ensure_views(conn)
+    refresh_kpis(conn)
+    # Statistiques du planificateur (échantillonnées : coût borné au démarrage)
+    conn.execute("PRAGMA analysis_limit = 1000;")
+    conn.execute("ANALYZE;")
     conn.commit()
 
 
+def _migrate_without_rowid(conn: sqlite3.Connection, table: str) -> None:
+    # Bases créées avant WITHOUT ROWID : reconstruction depuis le DDL stocké
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    if sql.rstrip().upper().endswith("WITHOUT ROWID"):
+        return
+    with tx(conn):
+        conn.execute(sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE {table}__new", 1) + " WITHOUT ROWID")
+        conn.execute(f"INSERT INTO {table}__new SELECT * FROM {table}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}__new RENAME TO {table}")
+
+
+def create_indexes(conn: sqlite3.Connection) -> None:
+    # conn.execute (et non executescript) : utilisable dans la transaction du seed
+    for name, target in DDL_INDEXES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+
+def drop_indexes(conn: sqlite3.Connection) -> None:
+    for name, _ in DDL_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_kpi_triggers(conn: sqlite3.Connection) -> None:
+    for name, event, body in KPI_TRIGGERS:
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+
+def drop_kpi_triggers(conn: sqlite3.Connection) -> None:
+    # Chargement en masse : un refresh_kpis final au lieu d'un UPSERT par ligne
+    for name, _, _ in KPI_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+def refresh_kpis(conn: sqlite3.Connection) -> None:
+    """Recalcule les tables KPI matérialisées depuis time_entries.
+
+    Resynchronisation complète (les triggers KPI assurent le suivi au fil de l'eau) :
+    au démarrage et après un chargement en masse fait triggers supprimés.
+    Pas de commit : s'exécute dans la transaction de l'appelant.
+    """
+    conn.execute("DELETE FROM kpi_mission_consumed_t")
+    conn.execute(
+        """
+        INSERT INTO kpi_mission_consumed_t(mission_id, consumed_hours)
+        SELECT mission_id, SUM(hours)
+        FROM time_entries
+        WHERE mission_id IS NOT NULL
+          AND category IN ('billable','non_billable_client')
+        GROUP BY mission_id
+        HAVING SUM(hours) > 0
+        """
+    )
+    conn.execute("DELETE FROM kpi_user_load_daily_t")
+    conn.execute(
+        """
+        INSERT INTO kpi_user_load_daily_t(day, user_id, logged_hours)
+        SELECT entry_date, user_id, SUM(hours)
+        FROM time_entries
+        GROUP BY entry_date, user_id
+        HAVING SUM(hours) > 0
+        """
+    )
+    conn.execute("DELETE FROM kpi_time_by_category_daily_t")
+    conn.execute(
+        """
+        INSERT INTO kpi_time_by_category_daily_t(day, category, hours)
+        SELECT entry_date, category, SUM(hours)
+        FROM time_entries
+        GROUP BY entry_date, category
+        HAVING SUM(hours) > 0
+        """
+    )
+
+
 def ensure_views(conn: sqlite3.Connection) -> None:
     # Drop (pour permettre les évolutions)
     conn.executescript(
@@ -385,21 +443,143 @@ def ensure_views(conn: sqlite3.Connection) -> None:
         DROP VIEW IF EXISTS kpi_alert_capacity_daily;
         DROP VIEW IF EXISTS kpi_capacity_daily;
         DROP VIEW IF EXISTS kpi_user_logged_daily;
+        DROP VIEW IF EXISTS kpi_mission_hours;
+        DROP VIEW IF EXISTS kpi_finance_mission;
+        DROP VIEW IF EXISTS kpi_user_load_daily;
+        DROP VIEW IF EXISTS kpi_simulation_summary;
+        DROP VIEW IF EXISTS kpi_time_by_category_daily;
         """
     )
 
     # Recreate
     conn.executescript(
         """
+        CREATE VIEW IF NOT EXISTS kpi_mission_hours AS
+        SELECT
+          m.id              AS mission_id,
+          m.code            AS mission_code,
+          m.name            AS mission_name,
+          c.name            AS client_name,
+          m.status          AS status,
+          m.start_date      AS start_date,
+          m.end_date        AS end_date,
+          m.sold_days       AS sold_days,
+          ROUND(m.sold_days * 8.0, 2) AS sold_hours,
+          COALESCE(k.consumed_hours, 0) AS consumed_hours,
+          ROUND((COALESCE(k.consumed_hours, 0) / NULLIF(m.sold_days * 8.0, 0)) * 100.0, 1) AS consumed_pct
+        FROM missions m
+        JOIN clients c ON c.id = m.client_id
+        LEFT JOIN kpi_mission_consumed_t k ON k.mission_id = m.id
+        WHERE m.is_active = 1;
+
+        CREATE VIEW IF NOT EXISTS kpi_finance_mission AS
+        SELECT
+          m.id AS mission_id,
+          m.code AS mission_code,
+          m.name AS mission_name,
+          c.name AS client_name,
+          m.sold_amount_eur AS sold_amount_eur,
+          m.daily_cost_eur  AS daily_cost_eur,
+          COALESCE(k.consumed_hours, 0) AS consumed_hours,
+          ROUND((COALESCE(k.consumed_hours, 0) / 8.0) * m.daily_cost_eur, 2) AS cost_eur,
+          ROUND(m.sold_amount_eur - ((COALESCE(k.consumed_hours, 0) / 8.0) * m.daily_cost_eur), 2) AS margin_eur
+        FROM missions m
+        JOIN clients c ON c.id = m.client_id
+        LEFT JOIN kpi_mission_consumed_t k ON k.mission_id = m.id
+        WHERE m.is_active = 1;
+
+        CREATE VIEW IF NOT EXISTS kpi_user_load_daily AS
+        SELECT
+          l.day,
+          u.id          AS user_id,
+          u.full_name   AS user_name,
+          l.logged_hours
+        FROM kpi_user_load_daily_t l
+        JOIN users u ON u.id = l.user_id
+        WHERE u.is_active = 1;
+
+        -- KPI Simulation (Board) : totaux CA / coûts calculés une fois (CTE totals),
+        -- marge et % dérivés de ces deux colonnes
+        CREATE VIEW IF NOT EXISTS kpi_simulation_summary AS
+        WITH
+        internal AS (
+          SELECT
+            simulation_id,
+            SUM(planned_days * hours_per_day) AS planned_hours,
+            SUM(planned_days * hours_per_day * billable_ratio) AS billable_hours,
+            SUM(planned_days * hours_per_day * std_rate_per_hour * billable_ratio) AS revenue_std,
+            SUM(planned_days * hours_per_day * std_cost_per_hour) AS cost_internal
+          FROM simulation_internal_resources
+          GROUP BY simulation_id
+        ),
+        external AS (
+          SELECT
+            simulation_id,
+            SUM(planned_days * sell_rate_per_day) AS revenue_external,
+            SUM(planned_days * buy_rate_per_day)  AS cost_external
+          FROM simulation_external_resources
+          GROUP BY simulation_id
+        ),
+        costs AS (
+          SELECT
+            simulation_id,
+            SUM(cost_amount) AS cost_other,
+            SUM(refactured_amount) AS revenue_other
+          FROM simulation_costs
+          GROUP BY simulation_id
+        ),
+        totals AS (
+          SELECT
+            s.id AS simulation_id,
+            s.mission_id,
+            s.client_name,
+            s.project_name,
+            s.sector,
+            s.start_date,
+            s.end_date,
+            s.status,
+            s.created_at,
+            COALESCE(i.planned_hours, 0) AS planned_hours,
+            COALESCE(i.billable_hours, 0) AS billable_hours,
+            -- CA = production std interne (billable) + vente externe + refacturations
+            (COALESCE(i.revenue_std, 0) + COALESCE(e.revenue_external, 0) + COALESCE(c.revenue_other, 0)) AS rev,
+            -- Coûts = interne + externe + autres
+            (COALESCE(i.cost_internal, 0) + COALESCE(e.cost_external, 0) + COALESCE(c.cost_other, 0)) AS cst
+          FROM simulations s
+          LEFT JOIN internal i ON i.simulation_id = s.id
+          LEFT JOIN external e ON e.simulation_id = s.id
+          LEFT JOIN costs c ON c.simulation_id = s.id
+        )
+        SELECT
+          simulation_id,
+          mission_id,
+          client_name,
+          project_name,
+          sector,
+          start_date,
+          end_date,
+          status,
+          created_at,
+          planned_hours,
+          billable_hours,
+          rev AS revenue_total,
+          cst AS cost_total,
+          (rev - cst) AS margin_total,
+          CASE WHEN rev = 0 THEN NULL ELSE ROUND(((rev - cst) / rev) * 100.0, 1) END AS margin_pct
+        FROM totals;
+
         CREATE VIEW IF NOT EXISTS kpi_user_logged_daily AS
         SELECT
-          te.entry_date AS day,
-          te.user_id,
+          l.day,
+          l.user_id,
           u.full_name AS user_name,
-          SUM(te.hours) AS logged_hours
-        FROM time_entries te
-        JOIN users u ON u.id = te.user_id
-        GROUP BY te.entry_date, te.user_id, u.full_name;
+          l.logged_hours
+        FROM kpi_user_load_daily_t l
+        JOIN users u ON u.id = l.user_id;
+
+        CREATE VIEW IF NOT EXISTS kpi_time_by_category_daily AS
+        SELECT day, category, hours
+        FROM kpi_time_by_category_daily_t;
 
         CREATE VIEW IF NOT EXISTS kpi_capacity_daily AS
         SELECT
@@ -418,7 +598,7 @@ def ensure_views(conn: sqlite3.Connection) -> None:
           day, user_id, user_name, capacity_h, logged_hours, over_h
         FROM kpi_capacity_daily
         WHERE over_h > 0
-        ORDER BY day DESC, over_h DESC;
+        ORDER BY day DESC, over_h DESC, user_id;
 
         CREATE VIEW IF NOT EXISTS kpi_alert_capacity_weekly AS
         SELECT
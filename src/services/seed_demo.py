@@ -1,10 +1,23 @@
 from __future__ import annotations
+import csv
+import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from operator import itemgetter
 from pathlib import Path
-import pandas as pd
+from typing import Iterator
 
 from src.config import Settings
+from src.db import bulk_insert, bulk_load, tx
 from src.security import hash_password
+from src.services.init_db import (
+    create_indexes,
+    create_kpi_triggers,
+    drop_indexes,
+    drop_kpi_triggers,
+    refresh_kpis,
+)
 
 SAMPLE_DIR = Path("data/sample")
 
@@ -19,106 +32,211 @@ def seed_demo_if_empty(conn: sqlite3.Connection, settings: Settings) -> None:
 
 def reset_demo(conn: sqlite3.Connection, settings: Settings, sample_dir: Path = SAMPLE_DIR) -> None:
     # Drop “soft” (V1) : truncate tables en respectant FK
-    conn.execute("DELETE FROM time_entries;")
-    conn.execute("DELETE FROM mission_assignments;")
-    conn.execute("DELETE FROM mission_leads;")
-    conn.execute("DELETE FROM missions;")
-    conn.execute("DELETE FROM clients;")
-    conn.execute("DELETE FROM capacity_overrides;")
-    conn.execute("DELETE FROM users;")
-    seed_from_csv(conn, settings=settings, sample_dir=sample_dir)
-
-def seed_from_csv(conn: sqlite3.Connection, settings: Settings, sample_dir: Path) -> None:
+    # Purge + rechargement dans une même transaction (rien de validé si le CSV est invalide)
+    # Hachage des mots de passe avant la transaction (verrou d'écriture non tenu pendant bcrypt)
+    users = _hash_users(settings, sample_dir)
+    with bulk_load(conn) as conn, tx(conn):
+        # Purge sans maintenance des index secondaires ni des KPI (recréés par seed_from_csv)
+        drop_indexes(conn)
+        drop_kpi_triggers(conn)
+        conn.execute("DELETE FROM time_entries;")
+        conn.execute("DELETE FROM mission_assignments;")
+        conn.execute("DELETE FROM mission_leads;")
+        conn.execute("DELETE FROM missions;")
+        conn.execute("DELETE FROM clients;")
+        conn.execute("DELETE FROM capacity_overrides;")
+        # Cascade users -> chat_audit faite à la main : FK désactivées (bulk_load),
+        # SQLite tronque sans cascade ni journal ligne à ligne.
+        # sqlite_sequence n'est pas remis à zéro : les ids repartent au-delà des
+        # anciens, une référence périmée (simulation, session) ne peut pas viser
+        # silencieusement une ligne rechargée.
+        conn.execute("DELETE FROM chat_audit;")
+        conn.execute("DELETE FROM users;")
+        seed_from_csv(conn, settings=settings, sample_dir=sample_dir, users=users)
+
+def _sniff(f) -> str:
+    # Séparateur détecté sur la seule ligne d'en-tête, puis retour au début du fichier
+    try:
+        delimiter = csv.Sniffer().sniff(f.readline(), delimiters=",;\t|").delimiter
+    except csv.Error:
+        delimiter = ","
+    f.seek(0)
+    return delimiter
+
+def _norm_header(fieldnames) -> list[str]:
+    return [c.lstrip("\ufeff").strip() for c in fieldnames or []]
+
+def _read_csv(path: Path, encoding: str, delimiter: str | None = None) -> Iterator[dict]:
+    """Lignes du CSV en dicts de chaînes (flux, sans DataFrame).
+
+    Séparateur détecté sur l'en-tête si non fourni ; en-têtes trim + BOM-safe.
+    """
+    with open(path, encoding=encoding, newline="") as f:
+        reader = csv.DictReader(f, delimiter=delimiter or _sniff(f))
+        reader.fieldnames = _norm_header(reader.fieldnames)
+        yield from reader
+
+def _read_rows(path: Path, encoding: str, cols: tuple[str, ...], delimiter: str | None = None) -> Iterator[tuple]:
+    """Variante positionnelle de _read_csv pour les gros fichiers : tuples des colonnes `cols`.
+
+    Pas de dict par ligne ; colonne absente de l'en-tête -> None, ligne vide ignorée,
+    ligne plus courte que l'en-tête -> ValueError (fichier tronqué ou mal délimité).
+    """
+    with open(path, encoding=encoding, newline="") as f:
+        reader = csv.reader(f, delimiter=delimiter or _sniff(f))
+        header = _norm_header(next(reader, None))
+        n = len(header)
+        pos = {c: i for i, c in enumerate(header)}
+        idx = [pos.get(c, n) for c in cols]
+        get = itemgetter(*idx)
+        pad = n in idx  # colonne absente : lue dans une cellule None ajoutée en fin de ligne
+        for row in reader:
+            if len(row) < n:
+                if not row:
+                    continue
+                raise ValueError(f"{path.name} ligne {reader.line_num} : {len(row)} colonnes sur {n}")
+            if pad:
+                row.append(None)
+            yield get(row)
+
+def _opt(v: str | None) -> str | None:
+    # cellule vide / absente -> NULL
+    return v if v not in (None, "", "NULL") else None
+
+def _int(v: str | None, default: int) -> int:
+    return int(float(v)) if _opt(v) is not None else default
+
+def _req_int(v: str | None, name: str) -> int:
+    # Colonne obligatoire : pas de valeur par défaut, l'import échoue
+    if _opt(v) is None:
+        raise ValueError(f"{name} manquant")
+    return int(float(v))
+
+def _float(v: str | None, default: float) -> float:
+    return float(v) if _opt(v) is not None else default
+
+def _hash_users(settings: Settings, sample_dir: Path) -> tuple[list[dict], list[str]]:
+    # Lignes de users.csv et hash bcrypt de leurs mots de passe. bcrypt libère le
+    # GIL : hachages indépendants répartis sur des threads.
+    users_rows = list(_read_csv(sample_dir / "users.csv", settings.csv_encoding))
+    pwds = [(r.get("password_clear") or "").strip() or settings.demo_admin_password for r in users_rows]
+    with ThreadPoolExecutor(max_workers=min(len(pwds), os.cpu_count() or 1) or 1) as ex:
+        pwd_hashes = list(ex.map(partial(hash_password, rounds=settings.bcrypt_rounds), pwds))
+    return users_rows, pwd_hashes
+
+def seed_from_csv(conn: sqlite3.Connection, settings: Settings, sample_dir: Path,
+                  users: tuple[list[dict], list[str]] | None = None) -> None:
     enc = settings.csv_encoding
     sample_dir.mkdir(parents=True, exist_ok=True)
 
     # ---- Users
-    users = pd.read_csv(sample_dir / "users.csv", encoding=enc, sep=None, engine="python")
-    users.columns = [c.strip().lstrip("\ufeff") for c in users.columns]  # trim + BOM-safe
-
-    for _, r in users.iterrows():
-        pwd_clear = str(r.get("password_clear", "")).strip() or settings.demo_admin_password
-        pwd_hash = hash_password(pwd_clear, rounds=settings.bcrypt_rounds)
-        conn.execute(
+    # bcrypt (lent) avant BEGIN IMMEDIATE : le verrou d'écriture n'attend pas les hash.
+    # Appelé dans une transaction (reset_demo), l'appelant fournit `users` hachés en amont.
+    users_rows, pwd_hashes = users or _hash_users(settings, sample_dir)
+
+    # Un seul BEGIN IMMEDIATE / COMMIT pour tout le chargement (rollback si erreur)
+    with bulk_load(conn) as conn, tx(conn):
+        # Index secondaires de time_entries et triggers KPI recréés en fin de chargement
+        drop_indexes(conn)
+        drop_kpi_triggers(conn)
+        conn.executemany(
             """INSERT INTO users(username, full_name, email, role, is_active, password_hash)
                VALUES (?, ?, ?, ?, ?, ?)""",
-            (r["username"], r["full_name"], r.get("email", None), r["role"], int(r.get("is_active", 1)), pwd_hash),
+            [
+                (r["username"], r["full_name"], _opt(r.get("email")), r["role"], _int(r.get("is_active"), 1), pwd_hash)
+                for r, pwd_hash in zip(users_rows, pwd_hashes)
+            ],
         )
+        # Correspondances nom -> id construites une fois (pas de SELECT par ligne enfant)
+        user_ids = dict(conn.execute("SELECT username, id FROM users").fetchall())
 
-    # ---- Clients
-    clients = pd.read_csv(sample_dir / "clients.csv", encoding=enc, sep=None, engine="python")
-    clients.columns = [c.strip().lstrip("\ufeff") for c in clients.columns]
-
-    for _, r in clients.iterrows():
-        conn.execute(
+        # ---- Clients
+        conn.executemany(
             "INSERT INTO clients(name, is_active) VALUES (?, ?)",
-            (r["name"], int(r.get("is_active", 1))),
+            ((r["name"], _int(r.get("is_active"), 1)) for r in _read_csv(sample_dir / "clients.csv", enc)),
         )
+        client_ids = dict(conn.execute("SELECT name, id FROM clients").fetchall())
 
-    # ---- Missions
-    missions = pd.read_csv(sample_dir / "missions.csv", encoding=enc, sep=None, engine="python")
-    missions.columns = [c.strip().lstrip("\ufeff") for c in missions.columns]
-
-    for _, r in missions.iterrows():
-        client_id = conn.execute("SELECT id FROM clients WHERE name=?", (r["client_name"],)).fetchone()["id"]
-        conn.execute(
+        # ---- Missions
+        conn.executemany(
             """INSERT INTO missions(client_id, code, name, status, start_date, end_date,
                                    sold_days, sold_amount_eur, daily_cost_eur, is_active, notes)
                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
             (
-                client_id, r["code"], r["name"], r.get("status", "ongoing"),
-                r["start_date"], (r.get("end_date", None) if pd.notna(r.get("end_date", None)) else None),
-                float(r.get("sold_days", 0)), float(r.get("sold_amount_eur", 0)), float(r.get("daily_cost_eur", 0)),
-                int(r.get("is_active", 1)), (r.get("notes", None) if pd.notna(r.get("notes", None)) else None)
+                (
+                    client_ids[r["client_name"]],
+                    r["code"], r["name"], _opt(r.get("status")) or "ongoing",
+                    r["start_date"], _opt(r.get("end_date")),
+                    _float(r.get("sold_days"), 0.0), _float(r.get("sold_amount_eur"), 0.0), _float(r.get("daily_cost_eur"), 0.0),
+                    _int(r.get("is_active"), 1), _opt(r.get("notes")),
+                )
+                for r in _read_csv(sample_dir / "missions.csv", enc)
             ),
         )
+        mission_ids = dict(conn.execute("SELECT code, id FROM missions").fetchall())
 
-    # ---- Leads
-    leads = pd.read_csv(sample_dir / "mission_leads.csv", encoding=enc, sep=None, engine="python")
-    leads.columns = [c.strip().lstrip("\ufeff") for c in leads.columns]
-
-    for _, r in leads.iterrows():
-        mid = conn.execute("SELECT id FROM missions WHERE code=?", (r["mission_code"],)).fetchone()["id"]
-        uid = conn.execute("SELECT id FROM users WHERE username=?", (r["lead_username"],)).fetchone()["id"]
-        conn.execute("INSERT OR IGNORE INTO mission_leads(mission_id, user_id) VALUES (?, ?)", (mid, uid))
-
-    # ---- Assignments
-    assign = pd.read_csv(sample_dir / "mission_assignments.csv", encoding=enc, sep=None, engine="python")
-    assign.columns = [c.strip().lstrip("\ufeff") for c in assign.columns]
-
-    for _, r in assign.iterrows():
-        mid = conn.execute("SELECT id FROM missions WHERE code=?", (r["mission_code"],)).fetchone()["id"]
-        uid = conn.execute("SELECT id FROM users WHERE username=?", (r["username"],)).fetchone()["id"]
-        conn.execute(
-            """INSERT INTO mission_assignments(mission_id, user_id, start_date, end_date, allocation_pct)
-               VALUES (?, ?, ?, ?, ?)""",
-            (mid, uid, r["start_date"], (r.get("end_date", None) if pd.notna(r.get("end_date", None)) else None), int(r.get("allocation_pct", 100))),
+        # ---- Leads
+        conn.executemany(
+            "INSERT OR IGNORE INTO mission_leads(mission_id, user_id) VALUES (?, ?)",
+            (
+                (mission_ids[r["mission_code"]], user_ids[r["lead_username"]])
+                for r in _read_csv(sample_dir / "mission_leads.csv", enc)
+            ),
         )
 
-    # ---- Time entries
-    te = pd.read_csv(sample_dir / "time_entries.csv", encoding=enc, sep=None, engine="python")
-    te.columns = [c.strip().lstrip("\ufeff") for c in te.columns]
-
-    for _, r in te.iterrows():
-        uid = conn.execute("SELECT id FROM users WHERE username=?", (r["username"],)).fetchone()["id"]
-        mission_id = None
-        if pd.notna(r.get("mission_code", None)) and str(r.get("mission_code", "")).strip():
-            mission_id = conn.execute("SELECT id FROM missions WHERE code=?", (r["mission_code"],)).fetchone()["id"]
+        # ---- Assignments
+        bulk_insert(
+            conn, "mission_assignments",
+            ("mission_id", "user_id", "start_date", "end_date", "allocation_pct"),
+            (
+                (
+                    mission_ids[r["mission_code"]],
+                    user_ids[r["username"]],
+                    r["start_date"], _opt(r.get("end_date")),
+                    _int(r.get("allocation_pct"), 100),
+                )
+                for r in _read_csv(sample_dir / "mission_assignments.csv", enc)
+            ),
+        )
 
-        conn.execute(
-            """INSERT OR IGNORE INTO time_entries(entry_date, user_id, mission_id, category, hours, description)
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (r["entry_date"], uid, mission_id, r["category"], int(r["hours"]), r.get("description", None)),
+        # ---- Time entries
+        # Fichier le plus volumineux : lu en flux, inséré par lots multi-lignes (mémoire bornée)
+        bulk_insert(
+            conn, "time_entries",
+            ("entry_date", "user_id", "mission_id", "category", "hours", "description"),
+            (
+                (
+                    day, user_ids[username],
+                    (mission_ids[code] if (code or "").strip() else None),
+                    category, _req_int(hours, "hours"), _opt(desc),
+                )
+                for day, username, code, category, hours, desc in _read_rows(
+                    sample_dir / "time_entries.csv", enc,
+                    ("entry_date", "username", "mission_code", "category", "hours", "description"),
+                )
+            ),
+            verb="INSERT OR IGNORE",
         )
 
-    # ---- Capacity overrides
-    cap_path = sample_dir / "capacity_overrides.csv"
-    if cap_path.exists():
-        caps = pd.read_csv(cap_path, encoding=enc)
-        for _, r in caps.iterrows():
-            uid = conn.execute("SELECT id FROM users WHERE username=?", (r["username"],)).fetchone()["id"]
-            conn.execute(
+        # ---- Capacity overrides
+        cap_path = sample_dir / "capacity_overrides.csv"
+        if cap_path.exists():
+            conn.executemany(
                 """INSERT OR IGNORE INTO capacity_overrides(user_id, cap_date, capacity_h, reason)
                    VALUES (?, ?, ?, ?)""",
-                (uid, r["cap_date"], int(r["capacity_h"]), r.get("reason", None)),
+                (
+                    (user_ids[r["username"]], r["cap_date"], _int(r["capacity_h"], 0), _opt(r.get("reason")))
+                    for r in _read_csv(cap_path, enc, delimiter=",")
+                ),
             )
+
+        # FK désactivées (bulk_load) : une passe d'intégrité globale au lieu d'une
+        # recherche par ligne insérée ; toute référence orpheline annule le chargement.
+        if not conn.execute("PRAGMA foreign_keys").fetchone()[0] and conn.execute("PRAGMA foreign_key_check").fetchone():
+            raise sqlite3.IntegrityError("FOREIGN KEY constraint failed")
+
+        create_indexes(conn)
+        create_kpi_triggers(conn)
+        refresh_kpis(conn)
+        # Statistiques pour le planificateur (choix des index couvrants)
+        conn.execute("ANALYZE")
@@ -1,6 +1,8 @@
 from __future__ import annotations
 from datetime import date, timedelta
+from functools import lru_cache
 
+@lru_cache(maxsize=1024)
 def week_bounds(d: date):
     start = d - timedelta(days=d.weekday())
     end = start + timedelta(days=6)
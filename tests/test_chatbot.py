@@ -0,0 +1,46 @@
+from src.config import load_settings
+from src.db import connect
+from src.services.chatbot import _extract_mission_code, _find_mission_by_name_or_code, _intent, _sanitize_question
+from src.services.init_db import ensure_schema
+
+def test_extract_mission_code_variants():
+    assert _extract_mission_code("où en est M-2026-002 ?") == "M-2026-002"
+    assert _extract_mission_code("m2026-002") == "M-2026-002"
+    assert _extract_mission_code("M 2026 002") == "M-2026-002"
+    assert _extract_mission_code("mission data") is None
+
+def test_sanitize_question_collapses_whitespace():
+    assert _sanitize_question("  Qui   est\tle PLUS chargé ? ") == "qui est le plus chargé ?"
+    assert _sanitize_question(None) == ""
+
+
+def test_intent_priority_order():
+    assert _intent("") == "help"
+    assert _intent("aide sur les risques") == "help"
+    assert _intent("qui est en surcharge ? risque ?") == "projects_risk"
+    assert _intent("répartition billable") == "time_split"
+    assert _intent("synthèse finance") == "finance_summary"
+    assert _intent("bonjour") == "status_global"
+
+
+def test_find_mission_follows_renames(tmp_path):
+    conn = connect(str(tmp_path / "t.db"))
+    ensure_schema(conn, settings=load_settings())
+    conn.execute("INSERT INTO clients(name) VALUES ('C')")
+    conn.execute(
+        "INSERT INTO missions(client_id, code, name, start_date) VALUES (1, 'M-2026-001', 'Refonte Entrepôt', '2026-01-01')"
+    )
+    assert _find_mission_by_name_or_code(conn, [1], "où en est la refonte entrepôt ?")["id"] == 1
+    conn.execute("UPDATE missions SET name = 'Audit Sécurité' WHERE id = 1")
+    assert _find_mission_by_name_or_code(conn, [1], "où en est la refonte entrepôt ?") is None
+    assert _find_mission_by_name_or_code(conn, [1], "et l'audit ÉTAT sécurité")["code"] == "M-2026-001"
+
+
+def test_find_mission_matches_partial_words(tmp_path):
+    conn = connect(str(tmp_path / "t.db"))
+    ensure_schema(conn, settings=load_settings())
+    conn.execute("INSERT INTO clients(name) VALUES ('C')")
+    conn.execute(
+        "INSERT INTO missions(client_id, code, name, start_date) VALUES (1, 'M-2026-001', 'Plateforme Logistique', '2026-01-01')"
+    )
+    assert _find_mission_by_name_or_code(conn, [1], "où en sont les plateformes logistiques ?")["id"] == 1
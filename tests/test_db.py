@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+from src.db import bulk_insert, bulk_load, connect, fetch_tuples, get_conn, tx
+
+def test_fetch_tuples_returns_plain_tuples():
+    conn = connect(":memory:")
+    conn.execute("CREATE TABLE t (id INTEGER, name TEXT)")
+    conn.executemany("INSERT INTO t VALUES (?, ?)", [(1, "a"), (2, "b")])
+    cols, rows = fetch_tuples(conn, "SELECT id, name FROM t WHERE id >= ? ORDER BY id", (1,))
+    assert cols == ["id", "name"]
+    assert rows == [(1, "a"), (2, "b")]
+    # la connexion garde sqlite3.Row pour les autres usages
+    assert conn.execute("SELECT name FROM t WHERE id=1").fetchone()["name"] == "a"
+
+def test_bulk_insert_batches_and_verb():
+    conn = connect(":memory:")
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT)")
+    rows = ((i, f"n{i}") for i in range(1200))  # 3 lots de 499 lignes max
+    bulk_insert(conn, "t", ("id", "name"), rows)
+    bulk_insert(conn, "t", ("id", "name"), [(5, "dup"), (1200, "x")], verb="INSERT OR IGNORE")
+    assert conn.execute("SELECT COUNT(*), MAX(id) FROM t").fetchone()[:] == (1201, 1200)
+    assert conn.execute("SELECT name FROM t WHERE id = 5").fetchone()[0] == "n5"
+
+def test_connect_applies_pragmas(tmp_path):
+    conn = connect(str(tmp_path / "t.db"))
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+
+def test_get_conn_is_private_to_caller(tmp_path):
+    a = get_conn(str(tmp_path / "a.db"))
+    b = get_conn(str(tmp_path / "a.db"))
+    assert a is not b and a.token != b.token
+    a.execute("CREATE TABLE t (id INTEGER)")
+    a.execute("INSERT INTO t VALUES (1)")
+    b.rollback()  # ne touche pas la transaction de a
+    a.commit()
+    assert b.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 1
+
+def test_tx_commits_or_rolls_back():
+    conn = connect(":memory:")
+    conn.execute("CREATE TABLE t (id INTEGER)")
+    with tx(conn):
+        conn.execute("INSERT INTO t VALUES (1)")
+    try:
+        with tx(conn):
+            conn.execute("INSERT INTO t VALUES (2)")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert not conn.in_transaction
+    assert [r[0] for r in conn.execute("SELECT id FROM t")] == [1]
+    # imbriqué : SAVEPOINT, un échec interne n'annule que sa part, l'appelant valide
+    with tx(conn):
+        conn.execute("INSERT INTO t VALUES (3)")
+        try:
+            with tx(conn):
+                conn.execute("INSERT INTO t VALUES (4)")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        with tx(conn):
+            conn.execute("INSERT INTO t VALUES (5)")
+        assert conn.in_transaction
+    assert not conn.in_transaction
+    assert [r[0] for r in conn.execute("SELECT id FROM t")] == [1, 3, 5]
+
+def test_bulk_load_keeps_fk_on_caller_connection(tmp_path):
+    conn = connect(str(tmp_path / "t.db"))
+    conn.execute("CREATE TABLE p (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE c (pid INTEGER REFERENCES p(id))")
+    conn.commit()
+    with bulk_load(conn) as bulk:
+        assert bulk is not conn
+        assert bulk.execute("PRAGMA foreign_keys").fetchone()[0] == 0
+        # pendant le chargement, les autres écritures restent contrôlées
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO c VALUES (1)")
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+    # transaction déjà ouverte : connexion de l'appelant, réglages intacts
+    conn.execute("INSERT INTO p VALUES (1)")
+    with bulk_load(conn) as bulk:
+        assert bulk is conn and conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
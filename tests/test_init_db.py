@@ -0,0 +1,53 @@
+from src.config import load_settings
+from src.db import connect
+from src.services.init_db import ensure_schema, refresh_kpis
+
+def test_kpi_tables_follow_time_entries(tmp_path):
+    conn = connect(str(tmp_path / "t.db"))
+    ensure_schema(conn, settings=load_settings())
+    conn.execute("INSERT INTO clients(name) VALUES ('C')")
+    conn.execute("INSERT INTO missions(client_id, code, name, start_date, sold_days) VALUES (1, 'M-1', 'M', '2026-01-01', 1)")
+    conn.execute("INSERT INTO users(username, password_hash, role, full_name) VALUES ('u', 'x', 'CONSULTANT', 'U')")
+    conn.executemany(
+        "INSERT INTO time_entries(entry_date, user_id, mission_id, category, hours) VALUES (?, 1, ?, ?, ?)",
+        [("2026-01-05", 1, "billable", 4), ("2026-01-05", 1, "internal", 4), ("2026-01-06", None, "internal", 8)],
+    )
+    assert tuple(conn.execute("SELECT consumed_hours, consumed_pct FROM kpi_mission_hours").fetchone()) == (4, 50.0)
+    rows = conn.execute("SELECT day, logged_hours FROM kpi_user_load_daily ORDER BY day").fetchall()
+    assert [tuple(r) for r in rows] == [("2026-01-05", 8), ("2026-01-06", 8)]
+    rows = conn.execute("SELECT day, category, hours FROM kpi_time_by_category_daily ORDER BY 1, 2").fetchall()
+    assert [tuple(r) for r in rows] == [("2026-01-05", "billable", 4), ("2026-01-05", "internal", 4), ("2026-01-06", "internal", 8)]
+
+    conn.execute("UPDATE time_entries SET mission_id = NULL WHERE category = 'billable'")
+    conn.execute("DELETE FROM time_entries WHERE entry_date = '2026-01-06'")
+    snapshot = lambda: [
+        conn.execute(f"SELECT * FROM {t} ORDER BY 1, 2").fetchall()
+        for t in ("kpi_mission_consumed_t", "kpi_user_load_daily_t", "kpi_time_by_category_daily_t")
+    ]
+    kept = [[tuple(r) for r in rows] for rows in snapshot()]
+    assert kept == [[], [("2026-01-05", 1, 8)], [("2026-01-05", "billable", 4), ("2026-01-05", "internal", 4)]]
+    refresh_kpis(conn)  # resynchronisation complète : mêmes tables
+    assert [[tuple(r) for r in rows] for rows in snapshot()] == kept
+
+
+def test_kpi_triggers_match_full_refresh(tmp_path):
+    conn = connect(str(tmp_path / "t.db"))
+    ensure_schema(conn, settings=load_settings())
+    conn.execute("INSERT INTO clients(name) VALUES ('C')")
+    conn.execute("INSERT INTO missions(client_id, code, name, start_date, sold_days) VALUES (1, 'M-1', 'M', '2026-01-01', 1)")
+    conn.execute("INSERT INTO users(username, password_hash, role, full_name) VALUES ('u', 'x', 'CONSULTANT', 'U')")
+    conn.executemany(
+        "INSERT INTO time_entries(entry_date, user_id, mission_id, category, hours) VALUES (?, 1, 1, ?, ?)",
+        [(f"2026-01-{d:02d}", c, h) for d in range(5, 10) for c, h in (("billable", 4), ("non_billable_client", 1))],
+    )
+    conn.execute("UPDATE time_entries SET hours = 8 WHERE entry_date = '2026-01-05'")
+    conn.execute("UPDATE time_entries SET category = 'internal', mission_id = NULL WHERE entry_date = '2026-01-06' AND category = 'billable'")
+    conn.execute("UPDATE time_entries SET entry_date = '2026-01-10' WHERE entry_date = '2026-01-07'")
+    conn.execute("DELETE FROM time_entries WHERE entry_date = '2026-01-08'")  # groupes retombés à 0
+    conn.execute("DELETE FROM time_entries WHERE category = 'non_billable_client'")
+    tables = ("kpi_mission_consumed_t", "kpi_user_load_daily_t", "kpi_time_by_category_daily_t")
+    snapshot = lambda: [[tuple(r) for r in conn.execute(f"SELECT * FROM {t} ORDER BY 1, 2")] for t in tables]
+    by_triggers = snapshot()
+    refresh_kpis(conn)
+    assert snapshot() == by_triggers
+    assert all(row[-1] > 0 for rows in by_triggers for row in rows)
@@ -0,0 +1,8 @@
+from src.security import hash_password, verify_password
+
+def test_verify_password_cache_keeps_rejecting_wrong_password():
+    h = hash_password("secret", rounds=4)
+    assert verify_password("secret", h)
+    assert verify_password("secret", h)
+    assert not verify_password("other", h)
+    assert not verify_password("secret", hash_password("x", rounds=4))
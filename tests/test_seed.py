@@ -0,0 +1,56 @@
+import shutil
+
+import pytest
+
+from src.config import load_settings
+from src.db import connect
+from src.services.init_db import ensure_schema
+from src.services.seed_demo import SAMPLE_DIR, _read_csv, _read_rows, reset_demo, seed_demo_if_empty, seed_from_csv
+
+def test_read_csv_sniffs_delimiter_and_strips_bom(tmp_path):
+    p = tmp_path / "users.csv"
+    p.write_text("﻿ username ; role;email\nadmin;ADMIN;\n", encoding="utf-8")
+    assert list(_read_csv(p, "utf-8")) == [{"username": "admin", "role": "ADMIN", "email": ""}]
+
+
+def test_read_rows_matches_read_csv(tmp_path):
+    p = tmp_path / "time_entries.csv"
+    p.write_text("entry_date;username;hours\n2026-01-02;u1;8\n\n2026-01-03;u2;4\n", encoding="utf-8")
+    cols = ("entry_date", "username", "hours", "description")
+    assert list(_read_rows(p, "utf-8", cols)) == [tuple(r.get(c) for c in cols) for r in _read_csv(p, "utf-8")]
+
+
+def test_read_rows_rejects_short_rows(tmp_path):
+    p = tmp_path / "time_entries.csv"
+    p.write_text("entry_date;username;hours\n2026-01-02;u1;8\n2026-01-03;u2\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="ligne 3"):
+        list(_read_rows(p, "utf-8", ("entry_date", "username", "hours")))
+
+
+def test_seed_requires_hours(tmp_path):
+    settings = load_settings()
+    conn = connect(str(tmp_path / "t.db"))
+    ensure_schema(conn, settings=settings)
+    sample = tmp_path / "sample"
+    shutil.copytree(SAMPLE_DIR, sample)
+    with open(sample / "time_entries.csv", "a", encoding="utf-8") as f:
+        f.write("2026-01-30,consult1,M-2026-001,billable,,oubli\n")
+    with pytest.raises(ValueError, match="hours"):
+        seed_from_csv(conn, settings=settings, sample_dir=sample)
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0  # rien de validé
+
+
+def test_reset_demo_without_fk_leaves_no_orphans(tmp_path):
+    settings = load_settings()
+    conn = connect(str(tmp_path / "t.db"))
+    ensure_schema(conn, settings=settings)
+    seed_demo_if_empty(conn, settings=settings)
+    conn.execute(
+        "INSERT INTO chat_audit(user_id, username, role, question, intent) "
+        "VALUES ((SELECT MIN(id) FROM users), 'admin', 'ADMIN', 'q', 'help')"
+    )
+    conn.commit()
+    reset_demo(conn, settings=settings)  # purge FK désactivées (bulk_load)
+    assert conn.execute("PRAGMA foreign_keys;").fetchone()[0] == 1
+    assert conn.execute("PRAGMA foreign_key_check;").fetchall() == []
+    assert conn.execute("SELECT COUNT(*) FROM chat_audit").fetchone()[0] == 0
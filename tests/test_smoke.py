@@ -1,5 +1,11 @@
-from src.config import load_settings
+from src.config import invalidate_settings, load_settings
 
 def test_settings_load():
     s = load_settings()
     assert s.db_path
+
+def test_settings_cached_until_invalidated():
+    s = load_settings()
+    assert load_settings() is s
+    invalidate_settings()
+    assert load_settings() is not s